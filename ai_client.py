@@ -1,42 +1,174 @@
-from pprint import pprint
+import asyncio
+import copy
+import logging
+import os
+import prompts
+import metrics
+import scheduler
+from logs import log_payload
+from response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+# Approximate token budget for a client's conversation, 0 disables it
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+
+# Completion tokens charged to a provider's tokens/min limit before a call
+EXPECTED_COMPLETION_TOKENS = int(os.getenv('EXPECTED_COMPLETION_TOKENS', '400'))
+
+# Marks the start of the summary of evicted turns in the system message
+SUMMARY_MARKER = "\n<SUMMARY>\n"
+
+def estimate_tokens(messages) -> int:
+    # roughly 4 characters per token plus a few tokens of overhead per message
+    return sum(len(message["content"]) // 4 + 4 for message in messages)
 
 class AIClient:
     def __init__(self, name: str):
         self.name = name
         self.messages = []
+        self.model = None
+        # optional ResponseCache used by aget_cached_json_response
+        self.response_cache: ResponseCache = None
+        # whether get_json_response is deterministic (temperature 0) and may be cached
+        self.deterministic_json = False
+        self.token_budget = CONTEXT_TOKEN_BUDGET
+        # label of the current call site (e.g. "CREATE_PLACES") for metrics
+        self.call_site = None
 
     def reset(self):
         self.messages = []
 
+    def conversation(self) -> 'AIClient':
+        """
+        A client with its own empty conversation that shares this client's
+        SDK clients and connection pools.
+        """
+        conversation = copy.copy(self)
+        conversation.messages = []
+        conversation.call_site = None
+        return conversation
+
     def init_chat(self):
         self.messages = []
 
+    # Async API. Providers override these with calls to their async SDK
+    # clients; the defaults only keep a provider without one usable by
+    # running the blocking call in a worker thread.
+    async def aprompt(self, text: str, call_site: str = None):
+        self.call_site = call_site
+        self.prompt(text)
+        await self.afit_context()
+
+    async def aget_response(self):
+        await self.acquire_quota()
+        with self.track_call():
+            return await asyncio.to_thread(self.get_response)
+
+    async def aget_json_response(self, type):
+        await self.acquire_quota()
+        with self.track_call():
+            return await asyncio.to_thread(self.get_json_response, type)
+
+    async def astream_response(self):
+        """
+        Yield the response text in chunks as it is generated; the full text is
+        added to the conversation at the end. Without a streaming
+        implementation the whole response is one chunk.
+        """
+        yield await self.aget_response()
+
+    async def acquire_quota(self):
+        """Wait for the provider's rate limits, see scheduler."""
+        await scheduler.acquire(self.name, estimate_tokens(self.messages) + EXPECTED_COMPLETION_TOKENS)
+
+    def track_call(self):
+        return metrics.track('llm', self.name, self.model, self.call_site)
+
+    async def aget_cached_json_response(self, type):
+        """
+        Same as aget_json_response, but served from the response cache when the
+        same provider, model, messages and schema were seen before. Call sites
+        opt in by calling this instead of aget_json_response.
+        """
+        if self.response_cache is None or not self.deterministic_json:
+            return await self.aget_json_response(type)
+
+        key = ResponseCache.make_key(self.name, self.model, self.messages, type)
+        # SQLite may wait for another process's write lock
+        json_data = await asyncio.to_thread(self.response_cache.get, key)
+        labels = {'provider': self.name, 'model': self.model or "", 'call_site': self.call_site or "unknown"}
+        if json_data is not None:
+            metrics.registry.inc("chatquest_llm_cache_hits_total", labels)
+            data = type.model_validate_json(json_data)
+            self.log_response_object(data)
+            return data
+
+        metrics.registry.inc("chatquest_llm_cache_misses_total", labels)
+        data = await self.aget_json_response(type)
+        await asyncio.to_thread(self.response_cache.put, key, data.model_dump_json())
+        return data
+
+    async def afit_context(self):
+        """
+        Keep the conversation within token_budget. The oldest turns are evicted
+        until the conversation is back to three quarters of the budget and
+        folded into a rolling summary kept in the system message. The system
+        message itself and the latest prompt are always kept.
+        """
+        if not self.token_budget or estimate_tokens(self.messages) <= self.token_budget:
+            return
+
+        system = None
+        turns = self.messages
+        if turns and turns[0]["role"] == "system":
+            system, turns = turns[0], turns[1:]
+
+        target = self.token_budget * 3 // 4
+        evicted = []
+        while len(turns) > 1 and estimate_tokens(([system] if system else []) + turns) > target:
+            evicted.append(turns[0])
+            turns = turns[1:]
+        # the kept conversation must start with a user turn
+        while len(turns) > 1 and turns[0]["role"] != "user":
+            evicted.append(turns[0])
+            turns = turns[1:]
+        if not evicted:
+            return
+
+        role_text, _, previous_summary = (system["content"] if system else "").partition(SUMMARY_MARKER)
+        summary = await self.asummarize(previous_summary, evicted)
+        logger.info("Folded messages into the conversation summary", extra={'provider': self.name, 'evicted': len(evicted)})
+
+        system_message = {"role": "system", "content": role_text + SUMMARY_MARKER + summary.strip()}
+        self.messages = [system_message] + turns
+
+    async def asummarize(self, previous_summary: str, messages) -> str:
+        conversation = "\n\n".join("{}: {}".format(message["role"], message["content"].strip()) for message in messages)
+
+        # summarize in a separate conversation
+        saved_messages, saved_call_site = self.messages, self.call_site
+        self.call_site = "SUMMARIZE_CONVERSATION"
+        self.messages = [
+            {"role": "system", "content": prompts.AGENT_ROLE},
+            {"role": "user", "content": prompts.SUMMARIZE_CONVERSATION.format(previous_summary.strip(), conversation)}
+        ]
+        try:
+            return await self.aget_response()
+        finally:
+            self.messages, self.call_site = saved_messages, saved_call_site
+
     def log_role(self, prompt: str):
-        label = "= " + self.name + " prompt "
-        print(label + ("=" * (50 - len(label))))
-        print(prompt.strip())
-        print("=" * 50)
+        log_payload(logger, "role", prompt, provider=self.name)
 
     def log_prompt(self, prompt: str):
-        label = "= " + self.name + " prompt "
-        print(label + ("=" * (50 - len(label))))
-        print(prompt.strip())
-        print("=" * 50)
+        log_payload(logger, "prompt", prompt, provider=self.name, call_site=self.call_site)
 
     def log_response_text(self, text: str):
-        label = "= " + self.name + " response JSON "
-        print(label + ("=" * (50 - len(label))))
-        print(text)
-        print("=" * 50)
+        log_payload(logger, "response text", text, provider=self.name, call_site=self.call_site)
 
     def log_response_json(self, json):
-        label = "= " + self.name + " response JSON "
-        print(label + ("=" * (50 - len(label))))
-        pprint(json)
-        print("=" * 50)
+        log_payload(logger, "response JSON", json, provider=self.name, call_site=self.call_site)
 
     def log_response_object(self, obj):
-        label = "= " + self.name + " response object "
-        print(label + ("=" * (50 - len(label))))
-        pprint(obj)
-        print("=" * 50)
+        log_payload(logger, "response object", obj, provider=self.name, call_site=self.call_site)
@@ -0,0 +1,285 @@
+"""
+End-to-end latency benchmark of the bot without real providers.
+
+Runs the real command handlers of chatquest through the application, with
+the "fake" LLM provider (see fake_client), a local stand-in for the Together
+images endpoint and a stand-in for the Bot API, and reports p50/p95/p99 per
+command and per generation stage:
+
+    python benchmark.py
+
+Settings are read from BENCH_* and FAKE_* environment variables.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+# concurrent chats, and rounds of commands each chat sends after /newgame
+BENCH_CHATS = int(os.getenv('BENCH_CHATS', '4'))
+BENCH_ROUNDS = int(os.getenv('BENCH_ROUNDS', '5'))
+# providers the bot is configured with; a comma separated list of fake
+# providers (e.g. "fake,fake-backup") benchmarks failover
+BENCH_PROVIDER = os.getenv('BENCH_PROVIDER', 'fake')
+# latency distribution (see fake_client.Latency) and failure rate of the image stand-in
+BENCH_IMAGE_LATENCY = os.getenv('BENCH_IMAGE_LATENCY', 'lognormal:1.5,0.3')
+BENCH_IMAGE_FAILURE_RATE = float(os.getenv('BENCH_IMAGE_FAILURE_RATE', '0'))
+# seconds to wait for the worlds to finish building after the last command
+BENCH_DRAIN_SECONDS = float(os.getenv('BENCH_DRAIN_SECONDS', '120'))
+BENCH_SEED = os.getenv('BENCH_SEED')
+BENCH_LOG_LEVEL = os.getenv('BENCH_LOG_LEVEL', 'WARNING')
+
+# the bot reads its configuration at import, so the benchmark's settings are
+# put in place first so that nothing reaches a real provider and every file
+# goes to a temporary directory
+bench_dir = tempfile.mkdtemp(prefix='chatquest-bench-')
+os.environ.update({
+    'STORY_ARCHITECT_PROVIDER': BENCH_PROVIDER,
+    'AI_PROVIDER': BENCH_PROVIDER,
+    'METAPROMPTER_PROVIDER': BENCH_PROVIDER,
+    'IMAGE_CACHE_DIR': '',
+    'RESPONSE_CACHE_PATH': '',
+    'HIBERNATE_DIR': os.path.join(bench_dir, 'hibernated'),
+    'HISTORY_DIR': os.path.join(bench_dir, 'history'),
+})
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:benchmark')
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import chatquest
+import imaging
+import logs
+import metrics
+from fake_client import Latency
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+# a 1x1 PNG
+IMAGE_B64 = ("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==")
+
+class ImagesHandler(BaseHTTPRequestHandler):
+    """Answers the Together image generation API after a sampled latency."""
+    latency = Latency(BENCH_IMAGE_LATENCY)
+    failure_rate = BENCH_IMAGE_FAILURE_RATE
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        time.sleep(self.latency.sample())
+        if random.random() < self.failure_rate:
+            self.respond(500, {"error": {"message": "injected failure"}})
+        elif payload.get('response_format') == 'url':
+            self.respond(200, {"data": [{"url": "http://{}:{}/image.png".format(*self.server.server_address)}]})
+        else:
+            self.respond(200, {"data": [{"b64_json": IMAGE_B64}]})
+
+    def do_GET(self):
+        body = base64.b64decode(IMAGE_B64)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, status: int, data: dict):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the bot gave up on the request, e.g. a cancelled prefetch
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def start_image_server() -> ThreadingHTTPServer:
+    """Serve the image stand-in on a free local port from a daemon thread."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImagesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class BotAPIRequest(BaseRequest):
+    """
+    Stands in for the connection to the Bot API: every method succeeds at
+    once. Records when each chat got its first message or photo since the
+    start of its current command.
+    """
+    def __init__(self):
+        self.message_ids = 0
+        self.command_start: Dict[int, float] = {}
+        self.first_reply: Dict[int, float] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def start_command(self, chat_id: int):
+        self.command_start[chat_id] = time.perf_counter()
+        self.first_reply.pop(chat_id, None)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        chat_id = parameters.get('chat_id')
+
+        if endpoint == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "ChatQuest", "username": "chatquest_bench_bot"}
+        elif endpoint in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            if endpoint != 'editMessageText' and chat_id in self.command_start and chat_id not in self.first_reply:
+                self.first_reply[chat_id] = time.perf_counter() - self.command_start[chat_id]
+            self.message_ids += 1
+            result = {
+                "message_id": parameters.get('message_id', self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+            if 'text' in parameters:
+                result['text'] = parameters['text']
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+class Benchmark:
+    def __init__(self, application, bot_api: BotAPIRequest):
+        self.application = application
+        self.bot_api = bot_api
+        self.update_ids = 0
+        # seconds until the handlers finished and until the first reply, by command
+        self.command_seconds: Dict[str, List[float]] = {}
+        self.first_reply_seconds: Dict[str, List[float]] = {}
+
+    def make_update(self, chat_id: int, text: str) -> Update:
+        self.update_ids += 1
+        command = text.split(' ', 1)[0]
+        data = {
+            "update_id": self.update_ids,
+            "message": {
+                "message_id": self.update_ids,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Player", "username": f"player{chat_id}"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+            },
+        }
+        return Update.de_json(data, self.application.bot)
+
+    async def command(self, chat_id: int, text: str):
+        name = text.split(' ', 1)[0]
+        self.bot_api.start_command(chat_id)
+        start = time.perf_counter()
+        await self.application.process_update(self.make_update(chat_id, text))
+        self.command_seconds.setdefault(name, []).append(time.perf_counter() - start)
+        if chat_id in self.bot_api.first_reply:
+            self.first_reply_seconds.setdefault(name, []).append(self.bot_api.first_reply[chat_id])
+
+    async def play(self, chat_id: int):
+        """One player: a new game, then rounds of looking around, interacting and moving."""
+        await self.command(chat_id, "/newgame a harbour town of smugglers")
+        for _ in range(BENCH_ROUNDS):
+            await self.command(chat_id, "/look")
+            await self.command(chat_id, "/who")
+            await self.command(chat_id, "/1 greet them")
+            await self.command(chat_id, "/talk what news from the road?")
+            await self.command(chat_id, random.choice(["/n", "/s", "/e", "/w"]))
+            await self.command(chat_id, "/map")
+
+    async def drain(self):
+        """
+        Wait for the worlds still building towns and prefetching images so
+        their stages are measured too and none is cut off by the shutdown.
+        """
+        tasks = [world.creation_task for world in chatquest.world_dict.values()
+                 if world.creation_task is not None and not world.creation_task.done()]
+        tasks += [task for world in chatquest.world_dict.values() if world.prefetcher is not None
+                  for task in world.prefetcher.tasks.values()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=BENCH_DRAIN_SECONDS)
+
+    async def run(self):
+        await asyncio.gather(*(self.play(chat_id) for chat_id in range(1, BENCH_CHATS + 1)))
+        await self.drain()
+
+def percentiles(values: List[float]) -> List[float]:
+    ordered = sorted(values)
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in PERCENTILES]
+
+def print_table(title: str, rows: Dict[str, List[float]]):
+    print()
+    print("{:<32} {:>6} {:>8} {:>8} {:>8}".format(title, "n", *("p{}".format(p) for p in PERCENTILES)))
+    for name, values in sorted(rows.items()):
+        print("{:<32} {:>6} {:>8.3f} {:>8.3f} {:>8.3f}".format(name, len(values), *percentiles(values)))
+
+def stage_rows(metric: str, prefix: str) -> Dict[str, List[float]]:
+    rows = {}
+    for key, values in metrics.registry.samples.get(metric, {}).items():
+        labels = dict(key)
+        rows.setdefault("{}:{}".format(prefix, labels.get('call_site', labels.get('priority', ''))), []).extend(values)
+    return rows
+
+def report(benchmark: Benchmark, seconds: float):
+    print("{} chats x {} rounds in {:.1f}s (provider {}, seconds)".format(BENCH_CHATS, BENCH_ROUNDS, seconds, BENCH_PROVIDER))
+    print_table("command", benchmark.command_seconds)
+    print_table("command, first reply", benchmark.first_reply_seconds)
+
+    stages = stage_rows("chatquest_llm_call_seconds", "llm")
+    stages.update(stage_rows("chatquest_image_call_seconds", "image"))
+    print_table("stage", stages)
+    print_table("stage, first byte", stage_rows("chatquest_llm_ttfb_seconds", "llm"))
+    print_table("scheduler wait", stage_rows("chatquest_scheduler_wait_seconds", "wait"))
+
+    failures = {
+        name: sum(metrics.registry.counters.get(name, {}).values())
+        for name in ("chatquest_llm_failures_total", "chatquest_image_failures_total", "chatquest_llm_failovers_total")
+    }
+    print()
+    for name, count in failures.items():
+        print("{:<32} {:>6.0f}".format(name, count))
+
+async def main():
+    logs.setup_logging(level=BENCH_LOG_LEVEL, stream=sys.stderr)
+    if BENCH_SEED is not None:
+        random.seed(BENCH_SEED)
+    metrics.registry.samples = {}
+
+    image_server = start_image_server()
+    imaging.IMAGES_URL = "http://{}:{}/v1/images/generations".format(*image_server.server_address)
+
+    bot_api = BotAPIRequest()
+    application = chatquest.build_application(os.path.join(bench_dir, 'bench.sqlite'), with_updater=False, request=bot_api)
+    await application.initialize()
+    benchmark = Benchmark(application, bot_api)
+    start = time.perf_counter()
+    try:
+        await benchmark.run()
+    finally:
+        await application.shutdown()
+        await imaging.close()
+        image_server.shutdown()
+        shutil.rmtree(bench_dir, ignore_errors=True)
+    report(benchmark, time.perf_counter() - start)
+
+if __name__ == '__main__':
+    asyncio.run(main())
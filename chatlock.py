@@ -0,0 +1,30 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict
+
+class ChatLocks:
+    """
+    One asyncio lock per chat so that updates of the same chat mutate its
+    world one at a time while different chats are processed concurrently.
+    A chat's lock is dropped again once nobody holds or waits for it.
+    """
+    def __init__(self):
+        self.locks: Dict[int, asyncio.Lock] = {}
+        # number of tasks holding or waiting for each chat's lock
+        self.users: Dict[int, int] = {}
+
+    def held(self, chat_id: int) -> bool:
+        return self.users.get(chat_id, 0) > 0
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        self.users[chat_id] = self.users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.users[chat_id] -= 1
+            if self.users[chat_id] == 0:
+                del self.users[chat_id]
+                del self.locks[chat_id]
@@ -1,17 +1,31 @@
-import os, requests, random
+import asyncio, functools, logging, os, requests, random
 from io import BytesIO
-from typing import Dict, List
+from typing import Dict
 from enum import Enum
-from pprint import pprint
-import prompts, metaprompts
+import prompts
 import mapgenerator as mapg
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
+from telegram.request import BaseRequest
 from client_factory import create_client
 
-import imaging
-from world import World, Town, Place, NPC, Point, TownList, PlaceList, NPCList, GenImage
+import logs
+import metrics
+import scheduler
+import sharding
+import streaming
+import worldgen
+import chunks
+from prefetch import NPCImagePrefetcher
+from history import ChatHistory
+from persistence import SQLiteDatabase, SQLitePersistence, WorldStore
+from hibernation import WorldHibernator
+from chatlock import ChatLocks
+from world import World, WorldMap, Town, Place, NPC, Point, InteractionOutcome
+from logs import log_payload
+
+logger = logging.getLogger(__name__)
 
 class Move(Enum):
     North = 1
@@ -23,17 +37,50 @@ class Move(Enum):
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# a comma separated list of providers (e.g. "mistral,groq") hedges and fails over in that order
 STORY_ARCHITECT_PROVIDER = os.getenv('STORY_ARCHITECT_PROVIDER')
 AI_PROVIDER = os.getenv('AI_PROVIDER')
 METAPROMPTER_PROVIDER = os.getenv('METAPROMPTER_PROVIDER', AI_PROVIDER)
+# start the game as soon as the starting town is ready and build the rest in the background
+PROGRESSIVE_CREATION = os.getenv('PROGRESSIVE_CREATION', 'true').lower() == 'true'
+# "pipeline" creates the world with one call per stage and town,
+# "blueprint" asks the story architect for the whole world in one call
+WORLD_CREATION_MODE = os.getenv('WORLD_CREATION_MODE', 'pipeline').lower()
+# "outcome" gets the narration and the NPC changes of an action or attack in one
+# structured call, "stream" streams the narration and updates the NPC afterwards
+NPC_INTERACTION_MODE = os.getenv('NPC_INTERACTION_MODE', 'outcome').lower()
+# "fixed" creates a map of five towns up front, "chunked" lays the map out in
+# chunks around the player and creates a chunk's towns when it is entered
+WORLD_MAP_MODE = os.getenv('WORLD_MAP_MODE', 'fixed').lower()
+# port of the local Prometheus metrics endpoint, 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# width and height in cells of the part of the map /map shows around the
+# player; 24 keeps the message well within Telegram's 4096 characters
+MAP_WINDOW = int(os.getenv('MAP_WINDOW', '24'))
+# how long a move waits for a town that is still being built
+TOWN_READY_TIMEOUT = float(os.getenv('TOWN_READY_TIMEOUT', '10'))
+
+# maximum number of updates processed at the same time, updates of one chat are still handled in order
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
+# number of worker processes, each owning a partition of the chats
+WORKERS = int(os.getenv('WORKERS', '1'))
+
+# SQLite database for worlds and bot_data, persistence is disabled when empty
+DB_PATH = os.getenv('DB_PATH', 'chatquest.sqlite')
+# hibernate cold worlds to files to stay under WORLD_MEMORY_MB
+HIBERNATION = os.getenv('HIBERNATION', 'true').lower() == 'true'
 
 world_dict = {}
+world_store: WorldStore = None
+world_hibernator: WorldHibernator = None
+chat_locks = ChatLocks()
 
 HELP_TEXT = """I'm here to create a game.
 /newgame <description> to begin a game
 /look to look around
 /who to find characters
 /n /s /e /w to move
+/goto <town> to travel to a town
 /1 /2 /... <action> to interact with characters
 /talk <message> to talk to the selected character (use /1 /2 /etc first to select a character)
 """
@@ -46,11 +93,11 @@ def register_game_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.bot_data["chat_ids"] = set()
     
     if chat_id not in context.bot_data["chat_ids"]:
-        print("New chat ID detected")
+        logger.info("New chat ID detected", extra={'chat_id': chat_id})
         context.bot_data["chat_ids"].add(chat_id)
         game_session = {
             'id': chat_id,
-            'history': []
+            'history': ChatHistory(chat_id)
         }
         context.bot_data[chat_key] = game_session
     else:
@@ -59,37 +106,40 @@ def register_game_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Ensure we always have a place to store the chat history
             game_session = {
                 'id': chat_id,
-                'history': []
+                'history': ChatHistory(chat_id)
             }
             context.bot_data[chat_key] = game_session
-            print(f"Recreated missing game session context for {chat_id}")
+            logger.info("Recreated missing game session context", extra={'chat_id': chat_id})
         else:
-            print(f"Found game session in context: {game_session['id']}")
+            logger.debug("Found game session in context", extra={'chat_id': chat_id})
 
     return game_session
 
-def store_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def store_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     game_session = register_game_session(update, context)
     user = update.effective_user
     username = user.username
     message = update.message.text
     
-    game_session['history'].append({'sender': username, 'message': message})
-    
-    print(game_session['id'])
-    print(game_session['history'])
+    await game_session['history'].append({'sender': username, 'message': message})
+
+    logger.debug("Stored message", extra={'chat_id': game_session['id'], 'history_length': len(game_session['history'])})
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    store_message(update, context)
+    await store_message(update, context)
     await send_message(update, context, HELP_TEXT)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    store_message(update, context)
+    await store_message(update, context)
     await send_message(update, context, HELP_TEXT)
 
 async def send_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
+async def stream_message(update: Update, context: ContextTypes.DEFAULT_TYPE, chunks) -> str:
+    """Show a response in the chat while it is generated and return the full text."""
+    return await streaming.stream_to_chat(context.bot, update.effective_chat.id, chunks)
+
 async def send_image(update: Update, context: ContextTypes.DEFAULT_TYPE, image: bytes, caption: str):
     await context.bot.send_photo(chat_id=update.effective_chat.id, photo=image, caption=caption)
 
@@ -99,50 +149,86 @@ async def display_none_status(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def display_creating_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_message(update, context, "Please wait while I create a new world for you.")
 
-def new_world(update: Update):
+def serialized(handler, while_creating: bool = False):
+    """
+    Run a command handler holding its chat's lock so that updates of one chat
+    mutate the world in order. While the chat's world is being created the
+    command is answered right away instead of waiting for the creation,
+    unless while_creating lets it wait for the lock (e.g. /newgame).
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id
+        world = world_dict.get(chat_id)
+        if world is not None and world.creating() and not while_creating:
+            await display_creating_status(update, context)
+            return
+        async with chat_locks.hold(chat_id):
+            await handler(update, context)
+    return wrapper
+
+def attach_clients(world: World):
+    world.story_architect_ai = create_client(STORY_ARCHITECT_PROVIDER)
+    world.ai = create_client(AI_PROVIDER)
+    world.metaprompter = create_client(METAPROMPTER_PROVIDER)
+    world.prefetcher = NPCImagePrefetcher(METAPROMPTER_PROVIDER)
+
+async def new_world(update: Update):
     chat_id = update.effective_chat.id
     new_world = World()
     world_dict[chat_id] = new_world
-    print(f'Created world: {chat_id}')
+    if world_hibernator is not None:
+        world_hibernator.discard(chat_id)
+    if world_store is not None:
+        await world_store.delete_world(chat_id)
+    logger.info("Created world", extra={'chat_id': chat_id})
     return new_world
 
-def get_world(update: Update):
+async def get_world(update: Update):
     chat_id = update.effective_chat.id
+    if world_hibernator is not None:
+        world_hibernator.touch(chat_id)
     
     if chat_id in world_dict:
-        print(f'Using world: {chat_id}')
+        logger.debug("Using world", extra={'chat_id': chat_id})
         return world_dict[chat_id]
+
+    if world_hibernator is not None:
+        rehydrated_world = await world_hibernator.rehydrate(chat_id)
+        if rehydrated_world is not None:
+            world_dict[chat_id] = rehydrated_world
+            resume_creation(rehydrated_world)
+            return rehydrated_world
+
+    if world_store is not None:
+        loaded_world = await world_store.load_world(chat_id)
+        if loaded_world is not None:
+            attach_clients(loaded_world)
+            loaded_world.ai.init_chat()
+            world_dict[chat_id] = loaded_world
+            logger.info("Loaded world", extra={'chat_id': chat_id})
+            resume_creation(loaded_world)
+            return loaded_world
     
     new_world = World()
     world_dict[chat_id] = new_world
-    print(f'Created world: {chat_id}')
+    logger.info("Created world", extra={'chat_id': chat_id})
     return new_world
 
-def get_npcs_text(npc_list: List[NPC]) -> tuple[int, str]:
-    text = ""
-    ctr = 0
-    for npc in npc_list:
-        ctr += 1
-        text += "{}. {} {}\n".format(ctr, npc.description, npc.appearance)
-    return ctr, text
-
-def get_npcs_image(metaprompter, npc_list) -> bytes:
-    num, npcs_text = get_npcs_text(npc_list)
-    meta_prompt = metaprompts.CHARACTERS.format(npcs_text)
-
-    metaprompter.reset()
-    metaprompter.prompt(meta_prompt)
-    img_prompt = metaprompter.get_response()
-    
-    image = imaging.generate_image_dynamic(img_prompt, cells = num)
-    return image
+def print_map(world_map: WorldMap):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Map:\n%s", "\n".join(str(row).replace("''", "'   '") for row in world_map.to_grid()))
 
-def print_map(grid):
-    for row in grid:
-        print(str(row).replace("''", "'   '"))
+def map_window(size: int, player: int, window: int) -> range:
+    """The 1-based coordinates of at most window cells around the player along one axis."""
+    start = min(max(1, player - window // 2), max(1, size - window + 1))
+    return range(start, min(size, start + window - 1) + 1)
 
-def render_map(grid, player_location: Point) -> str:
-    """Return a string representation of the map using colored emoji."""
+def render_map(world_map: WorldMap, player_location: Point, window: int = MAP_WINDOW) -> str:
+    """
+    Return a string representation of the map using colored emoji, cut to a
+    window of cells around the player so that it fits in a message.
+    """
     # Colors for up to seven different towns, cycle if more
     colors = [
         "🟥", "🟦", "🟩", "🟨", "🟪", "🟧", "🟫"
@@ -150,152 +236,185 @@ def render_map(grid, player_location: Point) -> str:
     empty = "⬜"
     player_dot = "🔴"
 
+    xs = map_window(world_map.width, player_location.x, window)
     lines = []
-    for y, row in enumerate(grid, start=1):
+    for y in map_window(world_map.height, player_location.y, window):
+        row = world_map.towns[(y - 1) * world_map.width + xs.start - 1:(y - 1) * world_map.width + xs.stop - 1]
         line = ""
-        for x, cell in enumerate(row, start=1):
+        for x, town_idx in zip(xs, row):
             if x == player_location.x and y == player_location.y:
                 line += player_dot
-            elif cell == "":
+            elif town_idx == 0:
                 line += empty
             else:
-                town_index = int(cell.split(":")[0]) - 1
-                line += colors[town_index % len(colors)]
+                line += colors[(town_idx - 1) % len(colors)]
         lines.append(line)
     return "\n".join(lines)
 
 async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global world_dict
 
-    world = new_world(update)
-
-    world.story_architect_ai = create_client(STORY_ARCHITECT_PROVIDER)
-    world.ai = create_client(AI_PROVIDER)
-    world.metaprompter = create_client(METAPROMPTER_PROVIDER)
+    world = await new_world(update)
+    attach_clients(world)
 
     world.set_creating()
 
-    store_message(update, context)
+    await store_message(update, context)
 
     await display_creating_status(update, context)
 
-    # create world
-    world.story_architect_ai.init_chat()
+    try:
+        # create world map
+        if WORLD_MAP_MODE == 'chunked':
+            world.chunks = chunks.WorldChunks(random.getrandbits(32))
+            town_places_count, start_location = world.chunks.start(world)
+        else:
+            grid, town_places_count, start_location = mapg.generate_map(5, 3, 5)
+            world.map = WorldMap.from_grid(grid)
 
-    instruction = prompts.CREATE_NEW_GAME.format(update.message.text.replace('/newgame ', ''))
-    world.story_architect_ai.prompt(instruction)
+        print_map(world.map)
+        logger.debug("Map generated", extra={'town_places_count': town_places_count, 'start_location': start_location})
 
-    world.description = world.story_architect_ai.get_response()
-    print(world.description)
+        world.location = Point(start_location[0], start_location[1])
 
-    # create world map
-    grid, town_places_count, start_location = mapg.generate_map(5, 3, 5)
+        theme = update.message.text.replace('/newgame ', '')
 
-    print_map(grid)
-    pprint(town_places_count)
-    pprint(start_location)
+        # players in a running game go first
+        with scheduler.priority(scheduler.Priority.CREATION):
+            created = False
+            if WORLD_CREATION_MODE == 'blueprint':
+                created = await create_world_blueprint(update, context, world, theme, town_places_count)
+            if created:
+                await send_message(update, context, world.description)
+            else:
+                # the pipeline streams the description while it creates the towns
+                await create_world_pipeline(update, context, world, theme, town_places_count)
+
+        logger.debug("Places created", extra={'places': len(world.places_dict)})
+
+        town_index, town, place_key, place = world.get_current_place()
+        world.current_town = town
+        await describe_scene(update, context, town_index, town, place_key, place, True)
+    except Exception:
+        logger.exception("World creation failed", extra={'chat_id': update.effective_chat.id})
+        world.set_not_started()
+        await send_message(update, context, "Sorry, the world could not be created. Use /newgame <description> to try again.")
+        return
 
-    world.map = grid
-    world.location = Point(start_location[0], start_location[1])
+    world.set_started()
+    if world.chunks is not None:
+        world.chunks.expand(world)
+    world.prefetcher.schedule(world)
+
+    if PROGRESSIVE_CREATION:
+        world.creation_task = asyncio.create_task(
+            worldgen.generate_remaining_towns(world, town_places_count, AI_PROVIDER, METAPROMPTER_PROVIDER)
+        )
+    else:
+        resume_creation(world)
 
-    # create towns
+async def create_world_pipeline(update: Update, context: ContextTypes.DEFAULT_TYPE, world: World, theme: str, town_places_count):
+    # create world description and towns concurrently; the towns prompt
+    # runs in a fresh conversation so it only knows the theme
     await send_message(update, context, "Creating towns ...")
     world.story_architect_ai.init_chat()
-    world.story_architect_ai.prompt(prompts.CREATE_TOWNS.format(len(town_places_count)))
-    world.towns = world.story_architect_ai.get_json_response(type = TownList).items
-
-    # create places in towns
-    await send_message(update, context, "Creating places ...")
-    town_count = 1
-    for town in world.towns:
-        pprint(town)
-        
-        world.ai.init_chat()
-        
-        instruction = prompts.CREATE_PLACES.format(town_places_count[town_count], world.description, town.description)
-        world.ai.prompt(instruction)
-
-        places = world.ai.get_json_response(type = PlaceList).items
-        place_count = 1
-        for place in places:
-            pprint(place)
-            place_key = "{}:{}".format(town_count, place_count)
-            world.places_dict[place_key] = place
-            place_count += 1
 
-        town_count += 1
-
-    pprint(world.places_dict)
-
-    # create town images
-    town_count = 1
+    instruction = prompts.CREATE_NEW_GAME.format(theme)
+    await world.story_architect_ai.aprompt(instruction, call_site="CREATE_NEW_GAME")
+
+    # the description is shown to the player while it is generated
+    world.description, towns = await asyncio.gather(
+        stream_message(update, context, world.story_architect_ai.astream_response()),
+        worldgen.create_towns(STORY_ARCHITECT_PROVIDER, prompts.THEME_WORLD.format(theme), len(town_places_count))
+    )
+    # extra towns have no place on the map
+    world.init_towns(towns[:len(town_places_count)])
+    log_payload(logger, "world description", world.description)
+
+    # create places, pictures and characters for every town concurrently;
+    # in progressive mode only the starting town (the one containing 1:1)
+    # is built before the game starts
+    await send_message(update, context, "Creating places, pictures and characters ...")
+    if PROGRESSIVE_CREATION:
+        failed = await worldgen.generate_towns(world, town_places_count, AI_PROVIDER, METAPROMPTER_PROVIDER, town_idxs=[1])
+    else:
+        failed = await worldgen.generate_towns(world, town_places_count, AI_PROVIDER, METAPROMPTER_PROVIDER)
+    # other towns that failed are generated again in the background
+    if 1 in failed:
+        raise RuntimeError("The starting town could not be created")
+
+async def create_world_blueprint(update: Update, context: ContextTypes.DEFAULT_TYPE, world: World, theme: str, town_places_count) -> bool:
+    """Create the world from a single blueprint call. Returns False if the blueprint was unusable."""
+    await send_message(update, context, "Creating towns, places and characters ...")
+    try:
+        blueprint = await worldgen.create_blueprint(STORY_ARCHITECT_PROVIDER, theme, town_places_count)
+        worldgen.add_blueprint(world, blueprint, town_places_count)
+    except Exception as e:
+        logger.warning("Blueprint creation failed, falling back to the pipeline: %s", e)
+        return False
+    log_payload(logger, "world description", world.description)
+
+    # in progressive mode the other town pictures are created in the background
     await send_message(update, context, "Creating pictures ...")
-    for town in world.towns:
-        meta_prompt = metaprompts.TOWN_IMAGE.format(town.description)
-        world.metaprompter.reset()
-        world.metaprompter.prompt(meta_prompt)
-        img_prompt = world.metaprompter.get_response()
-
-        image_data = imaging.generate_image_large(img_prompt)
-        world.towns_images.append(image_data)
-        if image_data is None:
-            print("No image for {}".format(town.name))
-        else:
-            print("Created image for {}".format(town.name))
-        town_count += 1
-
-    # create NPCs
-    await send_message(update, context, "Creating characters ...")
-    world.init_npc_dict()
-    for idx, town in enumerate(world.towns):
-        town_idx = idx + 1
-        
-        world.ai.init_chat()
-        
-        instruction = prompts.CREATE_NPCS.format(town_places_count[town_idx], town.description)
-        world.ai.prompt(instruction)
-
-        npc_list = world.ai.get_json_response(type = NPCList).items
-        pprint(npc_list)
-        
-        place_keys = [key for key in world.places_dict.keys() if key.startswith(f"{town_idx}:")]
-        for npc in npc_list:
-            selected_place_key = random.choice(place_keys)
-            world.npcs_dict[selected_place_key].append(npc)
-            pprint("{} - adding: {}".format(selected_place_key, npc.description))
-
-    # initialize empty image objects for the NPCs in each place
-    for place_key, npc_list in world.npcs_dict.items():
-        if len(npc_list) == 0:
-            world.places_npc_images_dict[place_key] = None
-        else:
-            world.places_npc_images_dict[place_key] = GenImage(data=bytes(), dirty=True)
+    if PROGRESSIVE_CREATION:
+        await worldgen.generate_town_images(world, METAPROMPTER_PROVIDER, town_idxs=[1])
+    else:
+        await worldgen.generate_town_images(world, METAPROMPTER_PROVIDER)
+    return True
+
+def resume_creation(world: World):
+    """
+    Restart generation of the towns a loaded world was still building when
+    the bot stopped, or that failed to generate.
+    """
+    if world.creation_task is not None and not world.creation_task.done():
+        return
+    if all(world.town_ready(town_idx) or not world.explored(town_idx) for town_idx in world.towns_ready):
+        return
+    world.creation_task = asyncio.create_task(
+        worldgen.generate_remaining_towns(world, world.get_town_places_count(), AI_PROVIDER, METAPROMPTER_PROVIDER)
+    )
 
-    await send_message(update, context, world.description)
-    
-    town_index, town, place_key, place = world.get_current_place()
-    world.current_town = town
-    await describe_scene(update, context, town_index, town, place_key, place, True)
+async def save_world(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs after the command handlers and stores what the update changed in the chat's world."""
+    if world_store is None or update.effective_chat is None:
+        return
+    chat_id = update.effective_chat.id
+    world = world_dict.get(chat_id)
+    if world is None or not world.started():
+        # nothing to store, and a world being created holds the chat's lock until it is done
+        return
+    async with chat_locks.hold(chat_id):
+        world = world_dict.get(chat_id)
+        if world is not None and world.started():
+            await world_store.save_world(chat_id, world)
+
+async def hibernate_worlds(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs after every update and hibernates cold worlds to stay under the memory ceiling."""
+    if world_hibernator is None:
+        return
+    keep = {update.effective_chat.id} if update.effective_chat is not None else set()
+    await world_hibernator.enforce(world_dict, keep)
 
-    world.set_started()
+async def save_all_worlds(application: Application):
+    for chat_id, world in list(world_dict.items()):
+        if world.started():
+            await world_store.save_world(chat_id, world)
 
 async def describe_scene(update: Update, context: ContextTypes.DEFAULT_TYPE, town_index, town, place_key, place, has_entered_new_town):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     print_map(world.map)
-    print("{} -> {}".format(world.location, world.get_place_key()))
+    logger.debug("Describe scene", extra={'location': world.location, 'place_key': world.get_place_key()})
 
     scene = None
     if has_entered_new_town:
         scene = "You have entered {0}. {1}".format(town.name, town.description)
         if world.towns_images[town_index] is not None:
-            img_data = world.towns_images[town_index]
-            print("Start - display image for town {}: {} bytes".format(town_index, len(img_data)))
             await send_image(update, context, world.towns_images[town_index], scene)
             scene = ""
-            print("End - display image for town {}".format(town_index))
     else:
         scene = "You are in {0}.".format(town.name)
 
@@ -303,10 +422,27 @@ async def describe_scene(update: Update, context: ContextTypes.DEFAULT_TYPE, tow
 
     await send_message(update, context, scene)
 
+async def wait_for_town(update: Update, context: ContextTypes.DEFAULT_TYPE, world: World, town_idx: int) -> bool:
+    """
+    Wait for a town the player is heading to that is not ready yet. In a
+    chunked world the towns of an unexplored chunk are created first.
+    """
+    if not world.explored(town_idx):
+        world.chunks.explore(world, town_idx, STORY_ARCHITECT_PROVIDER, AI_PROVIDER, METAPROMPTER_PROVIDER)
+        await send_message(update, context, "You are entering unexplored lands ...")
+    else:
+        # restarts generation if it failed earlier
+        resume_creation(world)
+        await send_message(update, context, "{} is still being built ...".format(world.towns[town_idx - 1].name))
+    if await world.wait_town_ready(town_idx, TOWN_READY_TIMEOUT):
+        return True
+    await send_message(update, context, "It is not ready yet. Try again in a moment.")
+    return False
+
 async def move(update: Update, context: ContextTypes.DEFAULT_TYPE, move):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     if world.not_started():
         await display_none_status(update, context)
@@ -327,17 +463,72 @@ async def move(update: Update, context: ContextTypes.DEFAULT_TYPE, move):
 
     if not world.can_move(new_location):
         await update.message.reply_text("You  cannot go that way.")
+    elif not world.town_ready(world.get_town_idx(new_location)):
+        if await wait_for_town(update, context, world, world.get_town_idx(new_location)):
+            world.location = new_location
+            world.ai.init_chat()
     else:
         world.location = new_location
         world.ai.init_chat()
 
+    if world.chunks is not None:
+        world.chunks.expand(world)
+
     town_index, town, place_key, place = world.get_current_place()
     has_entered_new_town = (world.current_town != town)
     world.current_town = town
     world.selected_npc_index = 0
 
     await describe_scene(update, context, town_index, town, place_key, place, has_entered_new_town)
-    
+
+    world.prefetcher.schedule(world)
+
+async def goto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Travel to the nearest place of a town in one step, without describing the places on the way."""
+    world = await get_world(update)
+
+    if world.not_started():
+        await display_none_status(update, context)
+        return
+    elif world.creating():
+        await display_creating_status(update, context)
+        return
+
+    parts = update.message.text.split(' ', 1)
+    if len(parts) == 1:
+        await send_message(update, context, "Use /goto <town> to travel to a town.")
+        return
+
+    town_idx = world.find_town(parts[1])
+    if town_idx is None:
+        await send_message(update, context, "There is no town called {}.".format(parts[1].strip()))
+        return
+    if town_idx == world.get_town_idx(world.location):
+        await send_message(update, context, "You are already in {}.".format(world.towns[town_idx - 1].name))
+        return
+
+    path = world.map.shortest_path(world.location, town_idx)
+    if path is None:
+        await send_message(update, context, "You cannot get there.")
+        return
+
+    if not world.town_ready(town_idx) and not await wait_for_town(update, context, world, town_idx):
+        return
+
+    world.location = path[-1]
+    world.ai.init_chat()
+    if world.chunks is not None:
+        world.chunks.expand(world)
+
+    town_index, town, place_key, place = world.get_current_place()
+    world.current_town = town
+    world.selected_npc_index = 0
+
+    logger.debug("Travelled", extra={'town_idx': town_idx, 'steps': len(path)})
+    await describe_scene(update, context, town_index, town, place_key, place, True)
+
+    world.prefetcher.schedule(world)
+
 async def go_north(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await move(update, context, str(Move.North))
 
@@ -353,7 +544,7 @@ async def go_west(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def look(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     if world.not_started():
         await display_none_status(update, context)
@@ -368,7 +559,7 @@ async def look(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def who(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     if world.not_started():
         await display_none_status(update, context)
@@ -386,51 +577,79 @@ async def who(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for idx, npc in enumerate(npcs):
             npc_text += "[{}] {}\n\n".format((idx+1), npc.description)
 
+        place_key = world.get_place_key()
         gen_image = world.get_place_image()
+        if gen_image.dirty:
+            # a prefetch for this place may already be generating the image
+            await world.prefetcher.wait(place_key)
         if gen_image.dirty:
             # regenerate image
-            gen_image.data = get_npcs_image(world.ai, world.get_npcs())
+            gen_image.data = await worldgen.get_npcs_image(world.metaprompter, world.get_npcs())
             gen_image.dirty = False
+        world.prefetcher.seen(place_key)
 
         await send_image(update, context, gen_image.data, npc_text)
 
 async def attack(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     target = update.message.text.replace('/attack ', '').strip()
 
     if target.isdigit():
         target_npc = world.get_npc(int(target))
-        print(f"Attack target: {target}")
+        logger.debug("Attack target", extra={'target': target})
 
         if target_npc is None:
             await send_message(update, context, "Invalid target.")
+        elif NPC_INTERACTION_MODE == 'outcome':
+            instruction = prompts.ATTACK_NPC_OUTCOME.format(target_npc.description, target_npc.appearance)
+            await interact(update, context, world, target_npc, instruction, "ATTACK_NPC_OUTCOME")
         else:
             instruction = prompts.ATTACK_NPC.format(target_npc.description)
-            world.ai.prompt(instruction)
+            await world.ai.aprompt(instruction, call_site="ATTACK_NPC")
             
-            action_result = world.ai.get_response()
-            print(f"Action result: {action_result}")
-            await send_message(update, context, action_result)
+            action_result = await stream_message(update, context, world.ai.astream_response())
+            log_payload(logger, "action result", action_result)
 
             # update NPC description
-            world.ai.prompt(prompts.CHANGE_NPC.format(target_npc.description, target_npc.appearance))
-            updated_npc = world.ai.get_json_response(type = NPC)
+            await world.ai.aprompt(prompts.CHANGE_NPC.format(target_npc.description, target_npc.appearance), call_site="CHANGE_NPC")
+            updated_npc = await world.ai.aget_json_response(type = NPC)
             target_npc.description = updated_npc.description
             target_npc.appearance = updated_npc.appearance
-            print(f"Changed NPC: {target_npc}")
+            log_payload(logger, "changed NPC", target_npc)
 
             # update place image
             world.places_npc_images_dict[world.get_place_key()].dirty = True
 
+async def interact(update: Update, context: ContextTypes.DEFAULT_TYPE, world: World, npc: NPC, instruction: str, call_site: str):
+    """
+    Get the narration of an interaction together with the NPC's new description
+    and appearance in one call. The narration is sent first, the NPC and the
+    image of its place are updated after it.
+    """
+    place_key = world.get_place_key()
+    await world.ai.aprompt(instruction, call_site=call_site)
+    outcome = await world.ai.aget_json_response(type = InteractionOutcome)
+    # the conversation keeps only what the player was told
+    world.ai.messages.append({"role": "assistant", "content": outcome.narration})
+
+    await send_message(update, context, outcome.narration)
+    log_payload(logger, "action result", outcome.narration)
+
+    npc.description = outcome.description
+    npc.appearance = outcome.appearance
+    log_payload(logger, "changed NPC", npc)
+
+    # update place image
+    world.places_npc_images_dict[place_key].dirty = True
 
 async def show_map(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display the world map as a colored grid with the player's position."""
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     if world.not_started():
         await display_none_status(update, context)
@@ -446,39 +665,41 @@ async def show_map(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def act(update: Update, context: ContextTypes.DEFAULT_TYPE, target: int, action: str):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
 
     target_npc = world.get_npc(target)
-    print(f"Action target: {target}")
+    logger.debug("Action target", extra={'target': target})
 
     if target_npc is None:
         await send_message(update, context, "Invalid target.")
+    elif NPC_INTERACTION_MODE == 'outcome':
+        instruction = prompts.ACTION_NPC_OUTCOME.format(action, target_npc.description, target_npc.appearance)
+        await interact(update, context, world, target_npc, instruction, "ACTION_NPC_OUTCOME")
     else:
         instruction = prompts.ACTION_NPC.format(action, target_npc.description)
-        world.ai.prompt(instruction)
+        await world.ai.aprompt(instruction, call_site="ACTION_NPC")
         
-        action_result = world.ai.get_response()
-        print(f"Action result: {action_result}")
-        await send_message(update, context, action_result)
+        action_result = await stream_message(update, context, world.ai.astream_response())
+        log_payload(logger, "action result", action_result)
 
         # update NPC description
-        world.ai.prompt(prompts.CHANGE_NPC_DESCRIPTION.format(target_npc.description))
-        updated_description = world.ai.get_response()
+        await world.ai.aprompt(prompts.CHANGE_NPC_DESCRIPTION.format(target_npc.description), call_site="CHANGE_NPC_DESCRIPTION")
+        updated_description = await world.ai.aget_response()
         target_npc.description = updated_description
 
-        world.ai.prompt(prompts.CHANGE_NPC_APPEARANCE.format(target_npc.appearance))
-        updated_appearance = world.ai.get_response()
+        await world.ai.aprompt(prompts.CHANGE_NPC_APPEARANCE.format(target_npc.appearance), call_site="CHANGE_NPC_APPEARANCE")
+        updated_appearance = await world.ai.aget_response()
         target_npc.appearance = updated_appearance
         
-        print(f"Changed NPC: {target_npc}")
+        log_payload(logger, "changed NPC", target_npc)
 
         # update place image
         world.places_npc_images_dict[world.get_place_key()].dirty = True
 
-def get_action(update: Update, selected_npc_index: int) -> str:
+async def get_action(update: Update, selected_npc_index: int) -> str:
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
     world.selected_npc_index = selected_npc_index
 
     parts = update.message.text.split(' ', 1)
@@ -488,29 +709,29 @@ def get_action(update: Update, selected_npc_index: int) -> str:
         return parts[1]
 
 async def act_1(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    action = get_action(update, 1)
+    action = await get_action(update, 1)
     if action is not None:
         await act(update, context, 1, action)
 
 async def act_2(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    action = get_action(update, 2)
+    action = await get_action(update, 2)
     if action is not None:
         await act(update, context, 2, action)
 
 async def act_3(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    action = get_action(update, 2)
+    action = await get_action(update, 2)
     if action is not None:
         await act(update, context, 2, action)
 
 async def act_4(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    action = get_action(update, 2)
+    action = await get_action(update, 2)
     if action is not None:
         await act(update, context, 2, action)
 
 async def talk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
     if world.selected_npc_index == 0:
         await send_message(update, context, "You are not talking to anyone.")
         return
@@ -525,7 +746,7 @@ async def talk(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def addnpc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global world_dict
 
-    world = get_world(update)
+    world = await get_world(update)
     
     parts = update.message.text.split(' ', 1)
     if len(parts) == 1:
@@ -540,28 +761,67 @@ async def addnpc(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await send_message(update, context, "NPC added")
 
-def main():
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(db_path: str = DB_PATH, with_updater: bool = True, request: BaseRequest = None,
+                      hibernation: bool = HIBERNATION) -> Application:
+    """
+    Build the bot application with all handlers, persistence and hibernation.
+    A request object replaces the connection to the Bot API (see benchmark).
+    """
+    global world_store, world_hibernator
+
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+    if request is not None:
+        builder = builder.request(request)
+    if not with_updater:
+        builder = builder.updater(None)
+    if db_path:
+        database = SQLiteDatabase(db_path)
+        world_store = WorldStore(database)
+        builder = builder.persistence(SQLitePersistence(database)).post_stop(save_all_worlds)
+    application = builder.build()
+    world_hibernator = WorldHibernator(attach_clients, chat_locks=chat_locks) if hibernation else None
 
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("newgame", new_game))
-    application.add_handler(CommandHandler("n", go_north))
-    application.add_handler(CommandHandler("s", go_south))
-    application.add_handler(CommandHandler("e", go_east))
-    application.add_handler(CommandHandler("w", go_west))
-    application.add_handler(CommandHandler("look", look))
-    application.add_handler(CommandHandler("who", who))
-    application.add_handler(CommandHandler("map", show_map))
-    application.add_handler(CommandHandler("attack", attack))
-    application.add_handler(CommandHandler("1", act_1))
-    application.add_handler(CommandHandler("2", act_2))
-    application.add_handler(CommandHandler("3", act_3))
-    application.add_handler(CommandHandler("4", act_4))
-    application.add_handler(CommandHandler("talk", talk))
-    application.add_handler(CommandHandler("t", talk))
-    application.add_handler(CommandHandler("addnpc", addnpc))
-
-    print("ChatQuest starting")
+    application.add_handler(CommandHandler("newgame", serialized(new_game, while_creating=True)))
+    application.add_handler(CommandHandler("n", serialized(go_north)))
+    application.add_handler(CommandHandler("s", serialized(go_south)))
+    application.add_handler(CommandHandler("e", serialized(go_east)))
+    application.add_handler(CommandHandler("w", serialized(go_west)))
+    application.add_handler(CommandHandler("goto", serialized(goto)))
+    application.add_handler(CommandHandler("look", serialized(look)))
+    application.add_handler(CommandHandler("who", serialized(who)))
+    application.add_handler(CommandHandler("map", serialized(show_map)))
+    application.add_handler(CommandHandler("attack", serialized(attack)))
+    application.add_handler(CommandHandler("1", serialized(act_1)))
+    application.add_handler(CommandHandler("2", serialized(act_2)))
+    application.add_handler(CommandHandler("3", serialized(act_3)))
+    application.add_handler(CommandHandler("4", serialized(act_4)))
+    application.add_handler(CommandHandler("talk", serialized(talk)))
+    application.add_handler(CommandHandler("t", serialized(talk)))
+    application.add_handler(CommandHandler("addnpc", serialized(addnpc)))
+    # store changed world entities after every update
+    application.add_handler(TypeHandler(Update, save_world), group=1)
+    # then hibernate cold worlds
+    if hibernation:
+        application.add_handler(TypeHandler(Update, hibernate_worlds), group=2)
+
+    return application
+
+def main():
+    logs.setup_logging()
+    sharding.check_shards(DB_PATH, WORKERS)
+
+    if WORKERS > 1:
+        # the front process only polls Telegram and hands updates to the workers
+        sharding.run_front(TELEGRAM_BOT_TOKEN, WORKERS, METRICS_PORT)
+        return
+
+    application = build_application()
+
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+
+    logger.info("ChatQuest starting")
 
     application.run_polling(stop_signals=None)
 
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import random
+from typing import Dict, List, Set, Tuple
+
+import scheduler
+import worldgen
+from mapgenerator import grow_shape, NEIGHBOR_STEPS
+from world import World, WorldMap, Town, Point
+
+logger = logging.getLogger(__name__)
+
+# width and height of a chunk in cells
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '8'))
+# towns per chunk and places per town
+CHUNK_TOWNS = int(os.getenv('CHUNK_TOWNS', '3'))
+CHUNK_MIN_PLACES = int(os.getenv('CHUNK_MIN_PLACES', '3'))
+CHUNK_MAX_PLACES = int(os.getenv('CHUNK_MAX_PLACES', '5'))
+
+Chunk = Tuple[int, int]
+
+class ChunkCells:
+    """Occupied cells of one chunk being laid out; cells outside the chunk count as occupied."""
+    def __init__(self, size: int):
+        self.size = size
+        self.owner: Dict[Tuple[int, int], int] = {}
+
+    def __contains__(self, cell) -> bool:
+        r, c = cell
+        return not (0 <= r < self.size and 0 <= c < self.size) or cell in self.owner
+
+    def free_neighbors(self, cells):
+        for r, c in cells:
+            for dr, dc in NEIGHBOR_STEPS:
+                if (r + dr, c + dc) not in self:
+                    yield (r + dr, c + dc)
+
+def layout_chunk(seed, cx: int, cy: int, size: int = CHUNK_SIZE, num_towns: int = CHUNK_TOWNS,
+                 min_places: int = CHUNK_MIN_PLACES, max_places: int = CHUNK_MAX_PLACES) -> List[List[Tuple[int, int]]]:
+    """
+    Lay out the towns of a chunk, the same for the same seed and chunk.
+
+    Town 1 of the chunk grows from its centre and every other town is docked
+    to a random earlier one. Then the middle cell of each edge is joined to
+    the towns by a straight line of places towards the centre, so a chunk
+    always connects to its four neighbours.
+
+    Returns:
+        For every town, its (row, col) cells within the chunk in row-major order.
+    """
+    rng = random.Random("{}:{}:{}".format(seed, cx, cy))
+    occupied = ChunkCells(size)
+    mid = size // 2
+    towns = []
+    for town in range(num_towns):
+        num_places = rng.randint(min_places, max_places)
+        if town == 0:
+            start = (mid, mid)
+        else:
+            candidates = list(occupied.free_neighbors(towns[rng.randrange(town)]))
+            if not candidates:
+                candidates = list(occupied.free_neighbors(list(occupied.owner)))
+            if not candidates:
+                break  # the chunk is full
+            start = rng.choice(candidates)
+        cells = grow_shape(start, num_places, occupied, rng)
+        for cell in cells:
+            occupied.owner[cell] = town
+        towns.append(cells)
+
+    for gateway, (dr, dc) in [((mid, 0), (0, 1)), ((mid, size - 1), (0, -1)), ((0, mid), (1, 0)), ((size - 1, mid), (-1, 0))]:
+        path = []
+        cell = gateway
+        # the centre belongs to town 1, so every line ends at a town
+        while cell not in occupied.owner:
+            path.append(cell)
+            cell = (cell[0] + dr, cell[1] + dc)
+        towns[occupied.owner[cell]].extend(path)
+        for path_cell in path:
+            occupied.owner[path_cell] = occupied.owner[cell]
+
+    return [sorted(cells) for cells in towns]
+
+class WorldChunks:
+    """
+    The chunks of a world in chunked mode. The map only covers the chunks laid
+    out so far: the one the player is in and its eight neighbours. Towns of a
+    neighbour chunk are placeholders ("unexplored") until the player enters the
+    chunk, which is when their names, places, pictures and NPCs are created.
+    """
+    def __init__(self, seed, size: int = CHUNK_SIZE):
+        self.seed = seed
+        self.size = size
+        # absolute coordinate (0-based x, y) of map location (1, 1)
+        self.origin = (0, 0)
+        self.chunks: Dict[Chunk, List[int]] = {}
+        self.town_chunks: Dict[int, Chunk] = {}
+        self.unexplored: Set[int] = set()
+        self.tasks: Dict[Chunk, asyncio.Task] = {}
+
+    # the exploration tasks are not part of the state
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['tasks'] = {}
+        return state
+
+    def to_json(self) -> dict:
+        return {
+            'seed': self.seed,
+            'size': self.size,
+            'origin': list(self.origin),
+            'chunks': [[cx, cy, town_idxs] for (cx, cy), town_idxs in self.chunks.items()],
+            'unexplored': sorted(self.unexplored),
+        }
+
+    @staticmethod
+    def from_json(data: dict) -> 'WorldChunks':
+        world_chunks = WorldChunks(data['seed'], data['size'])
+        world_chunks.origin = tuple(data['origin'])
+        for cx, cy, town_idxs in data['chunks']:
+            world_chunks.chunks[(cx, cy)] = town_idxs
+            for town_idx in town_idxs:
+                world_chunks.town_chunks[town_idx] = (cx, cy)
+        world_chunks.unexplored = set(data['unexplored'])
+        return world_chunks
+
+    def busy(self) -> bool:
+        return any(not task.done() for task in self.tasks.values())
+
+    def chunk_at(self, location: Point) -> Chunk:
+        return ((self.origin[0] + location.x - 1) // self.size, (self.origin[1] + location.y - 1) // self.size)
+
+    def start(self, world: World):
+        """Lay out the first chunk as the whole map. Returns the number of places of each town and the start location."""
+        world.map = WorldMap(self.size, self.size)
+        self.add_chunk(world, (0, 0), explored=True)
+        return world.get_town_places_count(), world.map.location_of("1:1")
+
+    def add_chunk(self, world: World, chunk: Chunk, explored: bool = False):
+        towns = layout_chunk(self.seed, chunk[0], chunk[1], self.size)
+        first_town_idx = len(world.towns or []) + 1
+        town_idxs = list(range(first_town_idx, first_town_idx + len(towns)))
+        if not explored:
+            world.add_towns([Town(name="", description="") for _ in towns])
+            self.unexplored.update(town_idxs)
+
+        left = chunk[0] * self.size - self.origin[0] + 1
+        top = chunk[1] * self.size - self.origin[1] + 1
+        for town_idx, cells in zip(town_idxs, towns):
+            for place_idx, (r, c) in enumerate(cells, start=1):
+                world.map.set(Point(left + c, top + r), town_idx, place_idx)
+            self.town_chunks[town_idx] = chunk
+        self.chunks[chunk] = town_idxs
+
+    def expand(self, world: World):
+        """Lay out the chunks around the player that are not on the map yet."""
+        cx, cy = self.chunk_at(world.location)
+        new_chunks = sorted(
+            (cx + dx, cy + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (cx + dx, cy + dy) not in self.chunks
+        )
+        if not new_chunks:
+            return
+
+        chunks = list(self.chunks) + new_chunks
+        min_cx, max_cx = min(x for x, _ in chunks), max(x for x, _ in chunks)
+        min_cy, max_cy = min(y for _, y in chunks), max(y for _, y in chunks)
+        origin = (min_cx * self.size, min_cy * self.size)
+        shift_x, shift_y = self.origin[0] - origin[0], self.origin[1] - origin[1]
+
+        world.map.grow(shift_x, shift_y, (max_cx - min_cx + 1) * self.size, (max_cy - min_cy + 1) * self.size)
+        world.location = Point(world.location.x + shift_x, world.location.y + shift_y)
+        self.origin = origin
+
+        for chunk in new_chunks:
+            self.add_chunk(world, chunk)
+        logger.debug("Expanded world", extra={'chunks': len(self.chunks), 'width': world.map.width, 'height': world.map.height})
+
+    def explore(self, world: World, town_idx: int, story_architect_provider: str,
+                ai_provider: str, metaprompter_provider: str):
+        """Start creating the towns of the chunk of an unexplored town, if that is not under way already."""
+        if town_idx not in self.unexplored:
+            return
+        chunk = self.town_chunks[town_idx]
+        task = self.tasks.get(chunk)
+        if task is not None and not task.done():
+            return
+        logger.info("Exploring chunk", extra={'chunk': chunk})
+        self.tasks[chunk] = asyncio.create_task(
+            self.create_chunk(world, chunk, story_architect_provider, ai_provider, metaprompter_provider))
+
+    async def create_chunk(self, world: World, chunk: Chunk, story_architect_provider: str,
+                           ai_provider: str, metaprompter_provider: str):
+        """
+        Create the towns of a chunk. They stay unexplored until they have
+        been generated, so a failed chunk is explored again the next time a
+        player heads into it.
+        """
+        scheduler.set_priority(scheduler.Priority.CREATION)
+        town_idxs = self.chunks[chunk]
+        try:
+            existing_names = [town.name for town_idx, town in enumerate(world.towns, start=1)
+                              if town_idx not in self.unexplored]
+            towns = await worldgen.create_more_towns(story_architect_provider, world.description, existing_names, len(town_idxs))
+            if len(towns) < len(town_idxs):
+                raise ValueError("Got {} towns for a chunk of {}".format(len(towns), len(town_idxs)))
+            for town_idx, town in zip(town_idxs, towns):
+                world.towns[town_idx - 1] = town
+            # towns that still failed are generated again by resume_creation
+            await worldgen.generate_towns(world, world.get_town_places_count(), ai_provider, metaprompter_provider, town_idxs)
+            self.unexplored.difference_update(town_idxs)
+        except Exception:
+            logger.exception("Chunk creation failed", extra={'chunk': chunk})
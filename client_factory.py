@@ -1,20 +1,53 @@
 import os
+from typing import Dict
 
+from ai_client import AIClient
 from openai_client import OpenAIClient
 from together_client import TogetherClient
 from groq_client import GroqClient
 from mistral_client import MistralClient
+from failover_client import FailoverClient
+from fake_client import FakeClient
+from response_cache import get_default_cache
 
+# provider clients by name, built once per process; their SDK clients and
+# connection pools are shared by every conversation created from them
+provider_clients: Dict[str, AIClient] = {}
 
 def create_client(name: str):
+    """
+    Create a conversation with a provider. The conversation has its own
+    messages but shares the provider's client with every other conversation
+    of the process, so this is cheap enough to call for every stage.
+    """
+    return provider_client(name).conversation()
+
+def provider_client(name: str) -> AIClient:
     name = (name or "").lower()
-    if name == "openai":
-        return OpenAIClient(os.getenv("OPENAI_API_KEY"))
+    if name not in provider_clients:
+        provider_clients[name] = build_client(name)
+    return provider_clients[name]
+
+def build_client(name: str) -> AIClient:
+    """
+    Build the client of a provider. A comma separated list of providers
+    (e.g. "mistral,groq") builds a FailoverClient trying them in that order.
+    "fake" and "fake-<name>" are local stand-ins for benchmarks, see fake_client.
+    """
+    if "," in name:
+        client = FailoverClient([provider_client(provider.strip()) for provider in name.split(",")])
+    elif name == "openai":
+        client = OpenAIClient(os.getenv("OPENAI_API_KEY"))
     elif name == "together":
-        return TogetherClient(os.getenv("TOGETHER_API_KEY"))
+        client = TogetherClient(os.getenv("TOGETHER_API_KEY"))
     elif name == "groq":
-        return GroqClient(os.getenv("GROQ_API_KEY"))
+        client = GroqClient(os.getenv("GROQ_API_KEY"))
     elif name == "mistral":
-        return MistralClient(os.getenv("MISTRAL_API_KEY"))
+        client = MistralClient(os.getenv("MISTRAL_API_KEY"))
+    elif name == "fake" or name.startswith("fake-"):
+        client = FakeClient(name)
     else:
         raise ValueError(f"Unsupported AI client: {name}")
+
+    client.response_cache = get_default_cache()
+    return client
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict, List
+
+import metrics
+from ai_client import AIClient
+
+logger = logging.getLogger(__name__)
+
+# a request still running after this percentile of its provider's latency is hedged
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+# hedge delay used until a provider has HEDGE_MIN_SAMPLES latencies
+HEDGE_DEFAULT_SECONDS = float(os.getenv('HEDGE_DEFAULT_SECONDS', '8'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# number of recent latencies per provider the percentile is taken from
+HEDGE_WINDOW = int(os.getenv('HEDGE_WINDOW', '200'))
+# consecutive failures that open a provider's circuit, and how long it stays open
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+
+class ProviderHealth:
+    """
+    Recent latencies and circuit breaker of one provider, shared by every
+    client of the process. Once the circuit has been open for
+    BREAKER_RESET_SECONDS the next call is let through as a trial; a failure
+    opens it again right away, a success closes it.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.failures = 0
+        self.open_until = 0.0
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def success(self, seconds: float):
+        self.latencies.append(seconds)
+        if self.failures >= BREAKER_FAILURES:
+            logger.info("Circuit closed", extra={'provider': self.name})
+            metrics.registry.set("chatquest_llm_circuit_open", 0, {'provider': self.name})
+        self.failures = 0
+        self.open_until = 0.0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            self.open_until = time.monotonic() + BREAKER_RESET_SECONDS
+            logger.warning("Circuit opened", extra={'provider': self.name, 'failures': self.failures})
+            metrics.registry.set("chatquest_llm_circuit_open", 1, {'provider': self.name})
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_SECONDS
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))]
+
+provider_health: Dict[str, ProviderHealth] = {}
+
+def get_health(name: str) -> ProviderHealth:
+    if name not in provider_health:
+        provider_health[name] = ProviderHealth(name)
+    return provider_health[name]
+
+class FailoverClient(AIClient):
+    """
+    Sends each request to the first provider whose circuit is closed. If it
+    has not answered after its hedge delay the request is also sent to the
+    next provider and the first answer wins; if it fails the next provider
+    is tried at once. The conversation lives here and is copied into the
+    provider client for every attempt.
+    """
+    def __init__(self, clients: List[AIClient]):
+        super().__init__("Failover({})".format(",".join(client.name for client in clients)))
+        self.clients = clients
+        self.model = clients[0].model
+        self.deterministic_json = all(client.deterministic_json for client in clients)
+
+    def conversation(self) -> AIClient:
+        # the attempts of each conversation write to their own provider messages
+        conversation = super().conversation()
+        conversation.clients = [client.conversation() for client in self.clients]
+        return conversation
+
+    def init_chat(self):
+        self.clients[0].init_chat()
+        self.messages = list(self.clients[0].messages)
+
+    def prompt(self, text: str):
+        self.messages.append({ "role": "user", "content": text })
+        self.log_prompt(text)
+
+    def available_clients(self) -> List[AIClient]:
+        clients = [client for client in self.clients if get_health(client.name).available()]
+        # with every circuit open the providers are still tried in order
+        return clients or self.clients
+
+    def prepare(self, client: AIClient):
+        # providers may edit messages in place (Groq appends the JSON schema)
+        client.messages = [dict(message) for message in self.messages]
+        client.call_site = self.call_site
+
+    def get_response(self):
+        return self.call_in_order('get_response')
+
+    def get_json_response(self, type):
+        return self.call_in_order('get_json_response', type)
+
+    def call_in_order(self, method: str, *args):
+        """Blocking calls fail over but are not hedged."""
+        error = None
+        for client in self.available_clients():
+            self.prepare(client)
+            health = get_health(client.name)
+            start = time.perf_counter()
+            try:
+                result = getattr(client, method)(*args)
+            except Exception as e:
+                health.failure()
+                logger.warning("Provider failed, failing over", extra={'provider': client.name}, exc_info=True)
+                metrics.registry.inc("chatquest_llm_failovers_total", {'provider': client.name})
+                error = e
+                continue
+            health.success(time.perf_counter() - start)
+            self.messages = client.messages
+            return result
+        raise error
+
+    async def aget_response(self):
+        return await self.hedged('aget_response')
+
+    async def aget_json_response(self, type):
+        return await self.hedged('aget_json_response', type)
+
+    async def astream_response(self):
+        """Streams fail over until the first chunk arrives and are not hedged."""
+        error = None
+        for client in self.available_clients():
+            self.prepare(client)
+            health = get_health(client.name)
+            start = time.perf_counter()
+            started = False
+            try:
+                async for chunk in client.astream_response():
+                    started = True
+                    yield chunk
+            except Exception as e:
+                health.failure()
+                if started:
+                    raise
+                logger.warning("Provider failed, failing over", extra={'provider': client.name}, exc_info=True)
+                metrics.registry.inc("chatquest_llm_failovers_total", {'provider': client.name})
+                error = e
+                continue
+            health.success(time.perf_counter() - start)
+            self.messages = client.messages
+            return
+        raise error
+
+    async def attempt(self, client: AIClient, method: str, args):
+        health = get_health(client.name)
+        start = time.perf_counter()
+        try:
+            result = await getattr(client, method)(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            health.failure()
+            raise
+        health.success(time.perf_counter() - start)
+        return result
+
+    async def hedged(self, method: str, *args):
+        clients = self.available_clients()
+        tasks: Dict[asyncio.Task, AIClient] = {}
+        launched = 0
+
+        def launch():
+            nonlocal launched
+            client = clients[launched]
+            launched += 1
+            self.prepare(client)
+            tasks[asyncio.create_task(self.attempt(client, method, args))] = client
+
+        launch()
+        error = None
+        try:
+            while tasks:
+                timeout = get_health(clients[launched - 1].name).hedge_delay() if launched < len(clients) else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info("Hedging slow provider", extra={'provider': clients[launched - 1].name, 'after': timeout})
+                    metrics.registry.inc("chatquest_llm_hedges_total", {'provider': clients[launched - 1].name})
+                    launch()
+                    continue
+
+                for task in done:
+                    client = tasks.pop(task)
+                    if task.exception() is None:
+                        self.messages = client.messages
+                        return task.result()
+                    error = task.exception()
+                    logger.warning("Provider failed, failing over", extra={'provider': client.name}, exc_info=error)
+                    metrics.registry.inc("chatquest_llm_failovers_total", {'provider': client.name})
+                    if launched < len(clients):
+                        launch()
+            raise error
+        finally:
+            # the losers of a hedge are cancelled
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+import typing
+from types import SimpleNamespace
+
+from pydantic import BaseModel
+
+import prompts
+from ai_client import AIClient, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# A local stand-in provider for benchmarks, created by the provider name
+# "fake". A name like "fake-slow" reads FAKE_SLOW_* settings and falls back to
+# the FAKE_* ones, so several fake providers can be combined for failover.
+
+# time to the first token, see Latency for the format
+FAKE_LATENCY = os.getenv('FAKE_LATENCY', 'lognormal:0.6,0.4')
+# completion speed and length of a text response
+FAKE_TOKENS_PER_SECOND = float(os.getenv('FAKE_TOKENS_PER_SECOND', '60'))
+FAKE_COMPLETION_TOKENS = int(os.getenv('FAKE_COMPLETION_TOKENS', '120'))
+# share of calls that fail
+FAKE_FAILURE_RATE = float(os.getenv('FAKE_FAILURE_RATE', '0'))
+# list items of a JSON response when the prompt asks for no number of them
+FAKE_LIST_ITEMS = int(os.getenv('FAKE_LIST_ITEMS', '5'))
+FAKE_MAX_LIST_ITEMS = int(os.getenv('FAKE_MAX_LIST_ITEMS', '20'))
+
+WORDS = (
+    "old harbour lantern misty tower market stone bridge quiet tavern river "
+    "guard merchant crooked alley bell rusty gate hooded stranger salt wind "
+    "copper roof narrow stair smoke candle ledger wagon orchard well"
+).split()
+
+class Latency:
+    """
+    A latency distribution in seconds: "fixed:<s>", "uniform:<min>,<max>",
+    "exponential:<mean>" or "lognormal:<median>,<sigma>".
+    """
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, params = spec.partition(':')
+        self.kind = kind.strip().lower()
+        self.params = [float(param) for param in params.split(',') if param.strip()]
+        if self.kind not in ('fixed', 'uniform', 'exponential', 'lognormal'):
+            raise ValueError(f"Unsupported latency distribution: {spec}")
+
+    def sample(self, rng: random.Random = random) -> float:
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == 'exponential':
+            return rng.expovariate(1 / self.params[0])
+        median, sigma = self.params
+        return median * rng.lognormvariate(0, sigma)
+
+class FakeProviderError(Exception):
+    pass
+
+def fake_setting(prefix: str, name: str, default):
+    return os.getenv(f'{prefix}_{name}', default)
+
+class FakeClient(AIClient):
+    """
+    Answers every request with made-up text after a sampled latency plus the
+    time to generate its tokens. JSON responses are built from the schema;
+    lists get as many items as the largest number in the prompt asks for.
+    """
+    def __init__(self, name: str = "fake"):
+        super().__init__(name.capitalize())
+        prefix = name.upper().replace('-', '_')
+        self.latency = Latency(fake_setting(prefix, 'LATENCY', FAKE_LATENCY))
+        self.tokens_per_second = float(fake_setting(prefix, 'TOKENS_PER_SECOND', FAKE_TOKENS_PER_SECOND))
+        self.completion_tokens = int(fake_setting(prefix, 'COMPLETION_TOKENS', FAKE_COMPLETION_TOKENS))
+        self.failure_rate = float(fake_setting(prefix, 'FAILURE_RATE', FAKE_FAILURE_RATE))
+        self.model = "fake"
+        self.deterministic_json = False
+
+    def init_chat(self):
+        self.messages = [
+            { "role": "system", "content": prompts.AGENT_ROLE }
+        ]
+
+    def prompt(self, text: str):
+        self.messages.append({ "role": "user", "content": text })
+        self.log_prompt(text)
+
+    def fail(self):
+        if random.random() < self.failure_rate:
+            raise FakeProviderError(f"Injected failure of {self.name}")
+
+    def usage(self, completion_tokens: int):
+        return SimpleNamespace(prompt_tokens=estimate_tokens(self.messages), completion_tokens=completion_tokens)
+
+    def generation_seconds(self, tokens: int) -> float:
+        return tokens / self.tokens_per_second if self.tokens_per_second else 0
+
+    def make_text(self) -> str:
+        return " ".join(random.choice(WORDS) for _ in range(self.completion_tokens)).capitalize() + "."
+
+    def list_items(self) -> int:
+        prompt = next((message["content"] for message in reversed(self.messages) if message["role"] == "user"), "")
+        numbers = [int(number) for number in re.findall(r'\d+', prompt)]
+        return min(max(max(numbers), 1), FAKE_MAX_LIST_ITEMS) if numbers else FAKE_LIST_ITEMS
+
+    def make_value(self, annotation, items: int):
+        origin = typing.get_origin(annotation)
+        if origin in (list, typing.List):
+            item_type = typing.get_args(annotation)[0]
+            return [self.make_value(item_type, items) for _ in range(items)]
+        if origin is typing.Union:
+            return self.make_value(next(arg for arg in typing.get_args(annotation) if arg is not type(None)), items)
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            return {name: self.make_value(field.annotation, items) for name, field in annotation.model_fields.items()}
+        if annotation is bool:
+            return random.random() < 0.5
+        if annotation in (int, float):
+            return annotation(random.randint(1, 10))
+        return " ".join(random.choice(WORDS) for _ in range(12)).capitalize()
+
+    def make_json(self, type):
+        data = type.model_validate(self.make_value(type, self.list_items()))
+        self.log_response_object(data)
+        return data
+
+    def reply(self, text: str) -> str:
+        self.messages.append({ "role": "assistant", "content": text })
+        self.log_response_text(text)
+        return text
+
+    def get_response(self):
+        time.sleep(self.latency.sample() + self.generation_seconds(self.completion_tokens))
+        self.fail()
+        return self.reply(self.make_text())
+
+    def get_json_response(self, type):
+        data = self.make_json(type)
+        time.sleep(self.latency.sample() + self.generation_seconds(estimate_tokens([{"content": data.model_dump_json()}])))
+        self.fail()
+        return data
+
+    async def aget_response(self):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            await asyncio.sleep(self.latency.sample() + self.generation_seconds(self.completion_tokens))
+            self.fail()
+            call.usage(self.usage(self.completion_tokens))
+        return self.reply(self.make_text())
+
+    async def aget_json_response(self, type):
+        await self.acquire_quota()
+        data = self.make_json(type)
+        tokens = estimate_tokens([{"content": data.model_dump_json()}])
+        with self.track_call() as call:
+            await asyncio.sleep(self.latency.sample() + self.generation_seconds(tokens))
+            self.fail()
+            call.usage(self.usage(tokens))
+        return data
+
+    async def astream_response(self):
+        await self.acquire_quota()
+        words = self.make_text().split(" ")
+        with self.track_call() as call:
+            await asyncio.sleep(self.latency.sample())
+            self.fail()
+            for word in words:
+                await asyncio.sleep(self.generation_seconds(1))
+                call.first_byte()
+                yield word + " "
+            call.usage(self.usage(len(words)))
+        self.reply(" ".join(words))
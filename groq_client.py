@@ -1,4 +1,4 @@
-from groq import Groq
+from groq import Groq, AsyncGroq
 import prompts
 import json
 import os
@@ -8,8 +8,10 @@ class GroqClient(AIClient):
     def __init__(self, api_key: str):
         super().__init__("Groq")
         self.client = Groq(api_key=api_key)
+        self.async_client = AsyncGroq(api_key=api_key)
         #self.model = "moonshotai/kimi-k2-instruct"
         self.model = os.getenv('GROQ_MODEL')
+        self.deterministic_json = True
 
     def init_chat(self):
         self.messages = [
@@ -48,3 +50,59 @@ class GroqClient(AIClient):
         data = type.model_validate_json(json_data)
         self.log_response_object(data)
         return data
+
+    async def aget_response(self):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0
+            )
+            call.usage(response.usage)
+        text = response.choices[0].message.content
+        self.messages.append({"role": "assistant", "content": text})
+        return text
+
+    async def astream_response(self):
+        await self.acquire_quota()
+        text = ""
+        with self.track_call() as call:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0,
+                stream=True
+            )
+            async for chunk in stream:
+                # Groq reports the usage with the last chunk
+                x_groq = getattr(chunk, 'x_groq', None)
+                if x_groq is not None:
+                    call.usage(getattr(x_groq, 'usage', None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    call.first_byte()
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+        self.messages.append({"role": "assistant", "content": text})
+        self.log_response_text(text)
+
+    async def aget_json_response(self, type):
+        await self.acquire_quota()
+        json_schema_text = json.dumps(type.model_json_schema(), indent=2)
+        self.messages[-1]["content"] += f"\nThe response must be in JSON of this schema: {json_schema_text}"
+        with self.track_call() as call:
+            completion = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=0,
+                response_format={
+                    "type": "json_object",
+                    "schema": type.model_json_schema(),
+                }
+            )
+            call.usage(completion.usage)
+        json_data = completion.choices[0].message.content
+        self.log_response_json(json_data)
+        data = type.model_validate_json(json_data)
+        self.log_response_object(data)
+        return data
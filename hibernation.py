@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import pickle
+import time
+import zlib
+from contextlib import nullcontext
+from typing import Dict, Tuple
+
+import metrics
+from world import World
+
+logger = logging.getLogger(__name__)
+
+# directory of the compressed files of hibernated worlds
+HIBERNATE_DIR = os.getenv('HIBERNATE_DIR', 'hibernated')
+# memory ceiling for the worlds kept in world_dict
+WORLD_MEMORY_MB = int(os.getenv('WORLD_MEMORY_MB', '256'))
+# worlds not accessed for this long are hibernated regardless of memory
+WORLD_IDLE_SECONDS = float(os.getenv('WORLD_IDLE_SECONDS', '1800'))
+# the size of a world with background work is measured again after this long
+WORLD_MEASURE_SECONDS = float(os.getenv('WORLD_MEASURE_SECONDS', '30'))
+
+class WorldHibernator:
+    """
+    Keeps world_dict under a memory ceiling by writing idle and least
+    recently used worlds to compressed files and reading them back on the
+    next access.
+    """
+    def __init__(self, attach_clients, directory: str = HIBERNATE_DIR,
+                 max_bytes: int = WORLD_MEMORY_MB * 1024 * 1024, idle_seconds: float = WORLD_IDLE_SECONDS,
+                 chat_locks = None):
+        # clients are not hibernated; attach_clients(world) creates new ones
+        self.attach_clients = attach_clients
+        # ChatLocks of the handlers; a world is only hibernated while its chat is idle
+        self.chat_locks = chat_locks
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.last_access: Dict[int, float] = {}
+        # memory size of each resident world and when it was measured
+        self.sizes: Dict[int, Tuple[int, float]] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, chat_id: int) -> str:
+        return os.path.join(self.directory, f"{chat_id}.world.z")
+
+    def touch(self, chat_id: int):
+        self.last_access[chat_id] = time.monotonic()
+
+    def hibernated(self, chat_id: int) -> bool:
+        return os.path.exists(self.path(chat_id))
+
+    def discard(self, chat_id: int):
+        """Forget a hibernated world, e.g. when the chat starts a new game."""
+        self.sizes.pop(chat_id, None)
+        if self.hibernated(chat_id):
+            os.remove(self.path(chat_id))
+
+    async def hibernate(self, chat_id: int, world: World):
+        state = pickle.dumps(world.to_state(), protocol=pickle.HIGHEST_PROTOCOL)
+        await asyncio.to_thread(self.write, chat_id, state)
+        self.last_access.pop(chat_id, None)
+        self.sizes.pop(chat_id, None)
+        metrics.registry.inc("chatquest_world_hibernations_total")
+        logger.info("Hibernated world", extra={'chat_id': chat_id, 'bytes': len(state)})
+
+    def write(self, chat_id: int, state: bytes):
+        tmp_path = self.path(chat_id) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(state))
+        os.replace(tmp_path, self.path(chat_id))
+
+    def read(self, chat_id: int) -> dict:
+        with open(self.path(chat_id), 'rb') as f:
+            state = pickle.loads(zlib.decompress(f.read()))
+        os.remove(self.path(chat_id))
+        return state
+
+    async def rehydrate(self, chat_id: int) -> World:
+        """Load a hibernated world, or return None if the chat has none."""
+        if not self.hibernated(chat_id):
+            return None
+        start = time.perf_counter()
+        state = await asyncio.to_thread(self.read, chat_id)
+        world = World.from_state(state)
+        self.attach_clients(world)
+        world.ai.messages = state['ai_messages']
+        elapsed = time.perf_counter() - start
+
+        self.touch(chat_id)
+        metrics.registry.inc("chatquest_world_rehydrations_total")
+        metrics.registry.observe("chatquest_world_rehydrate_seconds", elapsed)
+        logger.info("Rehydrated world", extra={'chat_id': chat_id, 'seconds': round(elapsed, 4)})
+        return world
+
+    def size(self, chat_id: int, world: World, changed: bool, now: float) -> int:
+        """
+        The memory size of a world, measured again only if it changed: the
+        chat handled an update, or background work may have added to the
+        world since the last measurement.
+        """
+        size, measured = self.sizes.get(chat_id, (None, 0))
+        if size is None or changed or (world.busy() and now - measured >= WORLD_MEASURE_SECONDS):
+            size = world.memory_size()
+            self.sizes[chat_id] = (size, now)
+        return size
+
+    async def enforce(self, world_dict: Dict[int, World], keep = ()):
+        """
+        Hibernate worlds idle for longer than idle_seconds, then the least
+        recently used ones until the rest fits in max_bytes. Worlds in keep,
+        worlds whose chat is handling an update and worlds with background
+        work in progress stay in memory. The chats in keep are the ones whose
+        world may have changed.
+        """
+        now = time.monotonic()
+        candidates = sorted(
+            (self.last_access.get(chat_id, 0), chat_id) for chat_id, world in world_dict.items()
+            if chat_id not in keep and world.started() and not world.busy()
+        )
+        sizes = {chat_id: self.size(chat_id, world, chat_id in keep, now) for chat_id, world in world_dict.items()}
+        total = sum(sizes.values())
+
+        for last_access, chat_id in candidates:
+            if now - last_access < self.idle_seconds and total <= self.max_bytes:
+                break
+            if self.chat_locks is not None and self.chat_locks.held(chat_id):
+                continue
+            # updates of this chat wait until the world has been written
+            async with self.chat_locks.hold(chat_id) if self.chat_locks is not None else nullcontext():
+                # a concurrent enforce may have hibernated it while this one waited
+                world = world_dict.pop(chat_id, None)
+                if world is None:
+                    continue
+                await self.hibernate(chat_id, world)
+            total -= sizes[chat_id]
+
+        metrics.registry.set("chatquest_worlds_resident", len(world_dict))
+        metrics.registry.set("chatquest_worlds_resident_bytes", total)
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import os
+from collections import deque
+
+# number of history entries per chat kept in memory
+HISTORY_MAX_IN_MEMORY = int(os.getenv('HISTORY_MAX_IN_MEMORY', '50'))
+# directory of the append-only per-chat logs of older entries
+HISTORY_DIR = os.getenv('HISTORY_DIR', 'history')
+
+class ChatHistory:
+    """
+    History of one chat: the most recent entries are kept in a ring buffer
+    and older entries spill to an append-only JSON lines file, written from
+    a worker thread. Iterating yields every entry, oldest first, and reads
+    the file on the calling thread.
+    """
+    def __init__(self, chat_id, max_in_memory: int = HISTORY_MAX_IN_MEMORY, directory: str = HISTORY_DIR):
+        self.chat_id = chat_id
+        self.directory = directory
+        self.recent = deque(maxlen=max_in_memory)
+        # number of entries in the file, counted on first use; entries
+        # spilled by an earlier run of the bot stay part of the history
+        self.spilled = None
+        # spills of one chat are written in order
+        self.lock = asyncio.Lock()
+
+    # the history is pickled with bot_data while the file is appended to
+    # separately, so the number of spilled entries is counted from the file
+    # again after loading instead of being stored
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['spilled'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.spilled = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{self.chat_id}.jsonl")
+
+    def count_spilled(self) -> int:
+        if self.spilled is None:
+            self.spilled = 0
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as f:
+                    self.spilled = sum(1 for _ in f)
+        return self.spilled
+
+    async def append(self, entry: dict):
+        async with self.lock:
+            if self.spilled is None:
+                await asyncio.to_thread(self.count_spilled)
+            if self.recent.maxlen == 0:
+                # nothing is kept in memory
+                await self.spill(entry)
+                return
+            if len(self.recent) == self.recent.maxlen:
+                await self.spill(self.recent[0])
+            self.recent.append(entry)
+
+    async def spill(self, entry: dict):
+        await asyncio.to_thread(self.write, entry)
+
+    def write(self, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.spilled += 1
+
+    def __len__(self) -> int:
+        return self.count_spilled() + len(self.recent)
+
+    def __iter__(self):
+        spilled = self.count_spilled()
+        if spilled:
+            with open(self.path, encoding='utf-8') as f:
+                for line, _ in zip(f, range(spilled)):
+                    yield json.loads(line)
+        yield from list(self.recent)
+
+    async def last(self, n: int):
+        """Return up to the n most recent entries, oldest first."""
+        if n <= len(self.recent):
+            return list(self.recent)[len(self.recent) - n:]
+        async with self.lock:
+            return await asyncio.to_thread(lambda: list(deque(self, maxlen=n)))
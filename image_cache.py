@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+class ImageCache:
+    """
+    Persistent content-addressed cache of generated images.
+
+    Images are stored as one file per key in a directory. The least recently
+    used images are evicted once the total size exceeds max_bytes; file
+    modification times carry the recency across restarts. Several processes
+    may share the directory, each evicting within its own max_bytes.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        # key -> size in bytes, least recently used first
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith('.img'):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name[:-len('.img')], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def make_key(model: str, prompt: str, width: int, height: int, steps: int, guidance: float) -> str:
+        params = [model, prompt, width, height, steps, guidance]
+        return hashlib.sha256(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.img')
+
+    def get(self, key: str) -> bytes:
+        with self.lock:
+            # an unknown key may have been written by another process sharing the directory
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self.path(key))
+            except OSError:
+                if key in self.entries:
+                    self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return None
+            if key not in self.entries:
+                self.entries[key] = len(data)
+                self.total_bytes += len(data)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+
+            # write to a temporary file first so readers never see a partial image
+            tmp_path = '{}.{}.tmp'.format(self.path(key), os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+        }
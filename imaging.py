@@ -1,12 +1,75 @@
+import asyncio
+import base64
+import json
 import os
-import requests
-from io import BytesIO
+import httpx
+import logging
+import metrics
+import scheduler
+from logs import log_payload
+from image_cache import ImageCache
+
+logger = logging.getLogger(__name__)
+
+MODEL = "black-forest-labs/FLUX.1-schnell"
+STEPS = 10
+GUIDANCE = 3.5
+
+# the benchmark points this at its local stand-in
+IMAGES_URL = os.getenv('IMAGES_URL', "https://api.together.xyz/v1/images/generations")
+
+# "base64" returns the image in the generation response and saves the
+# second round trip; "url" downloads it from the returned URL
+IMAGE_RESPONSE_FORMAT = os.getenv('IMAGE_RESPONSE_FORMAT', 'base64')
+
+# HTTP transport settings
+IMAGE_CONNECT_TIMEOUT = float(os.getenv('IMAGE_CONNECT_TIMEOUT', '5'))
+IMAGE_READ_TIMEOUT = float(os.getenv('IMAGE_READ_TIMEOUT', '30'))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_MB', '10')) * 1024 * 1024
+IMAGE_MAX_CONNECTIONS = int(os.getenv('IMAGE_MAX_CONNECTIONS', '10'))
+
+# on-disk cache of generated images, disabled when IMAGE_CACHE_DIR is empty
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', '.image_cache')
+IMAGE_CACHE_MAX_MB = int(os.getenv('IMAGE_CACHE_MAX_MB', '512'))
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB * 1024 * 1024) if IMAGE_CACHE_DIR else None
+
+# shared keep-alive connection pool, created on first use
+http_client: httpx.AsyncClient = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(IMAGE_READ_TIMEOUT, connect=IMAGE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=IMAGE_MAX_CONNECTIONS, max_keepalive_connections=IMAGE_MAX_CONNECTIONS),
+        )
+    return http_client
+
+async def close():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+async def read_limited(response: httpx.Response) -> bytes:
+    """Stream the response body, giving up once it exceeds IMAGE_MAX_BYTES."""
+    response.raise_for_status()
+    content_length = int(response.headers.get('content-length', '0'))
+    if content_length > IMAGE_MAX_BYTES:
+        raise ValueError(f"Response too large: {content_length} bytes")
+
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes():
+        size += len(chunk)
+        if size > IMAGE_MAX_BYTES:
+            raise ValueError(f"Response larger than {IMAGE_MAX_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
 
 def log_prompt(prompt: str):
-    label = "= imaging prompt "
-    print(label + ("=" * (50 - len(label))))
-    print(prompt.strip())
-    print("=" * 50)
+    log_payload(logger, "imaging prompt", prompt)
 
 def clean_prompt(prompt: str) -> str:
     # Check and clean up the prompt if needed
@@ -24,23 +87,32 @@ def clean_prompt(prompt: str) -> str:
 
     return prompt
 
-def generate_image(prompt: str, width: int, height: int) -> bytes:
+async def generate_image(prompt: str, width: int, height: int, call_site: str = None) -> bytes:
     TOGETHER_API_KEY = os.getenv('TOGETHER_API_KEY')
     
     prompt = clean_prompt(prompt)
     log_prompt(prompt)
+
+    cache_key = None
+    if image_cache is not None:
+        cache_key = ImageCache.make_key(MODEL, prompt, width, height, STEPS, GUIDANCE)
+        image_data = await asyncio.to_thread(image_cache.get, cache_key)
+        metrics.registry.set("chatquest_image_cache_hits_total", image_cache.hits)
+        metrics.registry.set("chatquest_image_cache_misses_total", image_cache.misses)
+        if image_data is not None:
+            logger.info("Image cache hit", extra=image_cache.stats())
+            return image_data
     
     try:
-        url = "https://api.together.xyz/v1/images/generations"
-
         payload = {
-            "model": "black-forest-labs/FLUX.1-schnell",
-            "steps": 10,
+            "model": MODEL,
+            "steps": STEPS,
             "n": 1,
             "height": height,
             "width": width,
-            "guidance": 3.5,
-            "prompt": prompt
+            "guidance": GUIDANCE,
+            "prompt": prompt,
+            "response_format": IMAGE_RESPONSE_FORMAT
         }
         headers = {
             "accept": "application/json",
@@ -48,27 +120,35 @@ def generate_image(prompt: str, width: int, height: int) -> bytes:
             "authorization": "Bearer {}".format(TOGETHER_API_KEY)
         }
 
-        response = requests.post(url, json=payload, headers=headers)
-        json_response = response.json()
-        image_url = json_response['data'][0]['url']
-        
-        image_response = requests.get(image_url)
-        if image_response.status_code == 200:
-            io = BytesIO(image_response.content)
-            return io.getvalue()
-            
-        return None
+        await scheduler.acquire('Together_Images')
+        with metrics.track('image', 'Together', MODEL, call_site) as call:
+            client = get_http_client()
+            async with client.stream("POST", IMAGES_URL, json=payload, headers=headers) as response:
+                call.first_byte()
+                json_response = json.loads(await read_limited(response))
+            image = json_response['data'][0]
+
+            if image.get('b64_json'):
+                image_data = base64.b64decode(image['b64_json'])
+            else:
+                # the provider only returned a URL
+                async with client.stream("GET", image['url']) as image_response:
+                    image_data = await read_limited(image_response)
+
+        if cache_key is not None:
+            await asyncio.to_thread(image_cache.put, cache_key, image_data)
+        return image_data
         
     except Exception as e:
-        print(f"Image generation failed: {str(e)}")
+        logger.warning("Image generation failed: %s", e, extra={'call_site': call_site})
         return None
     
-def generate_image_large(prompt: str) -> bytes:
-    return generate_image(prompt, 512, 512)
+async def generate_image_large(prompt: str, call_site: str = None) -> bytes:
+    return await generate_image(prompt, 512, 512, call_site)
 
-def generate_image_dynamic(prompt: str, cells: int) -> bytes:
+async def generate_image_dynamic(prompt: str, cells: int, call_site: str = None) -> bytes:
     if cells == 1:
         width = 512
     else:
         width = cells * 256
-    return generate_image(prompt, width, 256)
\ No newline at end of file
+    return await generate_image(prompt, width, 256, call_site)
@@ -0,0 +1,89 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# LOG_LEVEL gates everything; DEBUG is needed for full prompt/response payloads
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# "json" writes one JSON object per line, "text" a human readable line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# fraction of full prompt/response payloads that are logged at DEBUG level
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.1'))
+# payloads longer than this are truncated
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', '4000'))
+
+# attributes every LogRecord has; anything else was passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+listener: logging.handlers.QueueListener = None
+
+def setup_logging(level: str = LOG_LEVEL, format: str = LOG_FORMAT, stream = None):
+    """
+    Route all logging through a queue so that formatting and writing happen
+    on a background thread instead of the event loop.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter() if format == 'json' else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    # the HTTP libraries log every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('httpcore').setLevel(logging.WARNING)
+
+def log_payload(logger: logging.Logger, kind: str, payload, **fields):
+    """
+    Log a full prompt or response at DEBUG level for a sample of calls.
+    Nothing is formatted unless the payload is actually logged.
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+
+    text = payload if isinstance(payload, str) else repr(payload)
+    text = text.strip()
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        text = text[:LOG_PAYLOAD_MAX_CHARS] + "..."
+    logger.debug(kind, extra={'payload': text, **fields})
@@ -1,27 +1,58 @@
 import random
 
-def generate_contiguous_shape(num_cells):
+NEIGHBOR_STEPS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+def grow_shape(start, num_cells, occupied, rng=random):
+    """
+    Grow a contiguous cluster of num_cells cells from start into cells that
+    are not occupied.
+
+    A frontier of the free cells next to the cluster is kept up to date as
+    cells are added, so each step picks a random frontier cell in O(1)
+    instead of rescanning the whole cluster. The cluster is complete unless
+    start lies in an enclosed pocket of free cells smaller than num_cells.
+
+    Returns:
+        The list of cells in the order they were added, starting with start.
+    """
+    cells = [start]
+    in_shape = {start}
+    frontier = []
+    in_frontier = set()
+
+    def extend(cell):
+        r, c = cell
+        for dr, dc in NEIGHBOR_STEPS:
+            neighbor = (r + dr, c + dc)
+            if neighbor not in in_shape and neighbor not in in_frontier and neighbor not in occupied:
+                frontier.append(neighbor)
+                in_frontier.add(neighbor)
+
+    extend(start)
+    while len(cells) < num_cells and frontier:
+        # swap the picked cell to the end so that removing it is O(1)
+        i = rng.randrange(len(frontier))
+        frontier[i], frontier[-1] = frontier[-1], frontier[i]
+        cell = frontier.pop()
+        in_frontier.discard(cell)
+        cells.append(cell)
+        in_shape.add(cell)
+        extend(cell)
+    return cells
+
+def generate_contiguous_shape(num_cells, rng=random):
     """
     Generate a contiguous cluster of exactly num_cells cells.
     
-    The algorithm starts at (0, 0) and then repeatedly adds a random neighbor
-    (up, down, left, or right) of an already–included cell until the shape contains
-    the desired number of cells. This ensures that all cells in the shape are contiguous.
+    The algorithm starts at (0, 0) and then repeatedly adds a random cell of the
+    frontier (the cells up, down, left or right of an already–included cell)
+    until the shape contains the desired number of cells. This ensures that all
+    cells in the shape are contiguous.
     
     Returns:
         A sorted list (row-major order) of (row, col) tuples representing local coordinates.
     """
-    shape = {(0, 0)}
-    while len(shape) < num_cells:
-        candidates = []
-        for (r, c) in shape:
-            for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                neighbor = (r + dr, c + dc)
-                if neighbor not in shape:
-                    candidates.append(neighbor)
-        if not candidates:
-            break  # Should not happen unless num_cells == 0.
-        shape.add(random.choice(candidates))
+    shape = grow_shape((0, 0), num_cells, set(), rng)
     
     # Normalize the shape so that the smallest row and col are 0.
     min_r = min(r for r, c in shape)
@@ -30,17 +61,67 @@ def generate_contiguous_shape(num_cells):
     normalized.sort(key=lambda pos: (pos[0], pos[1]))
     return normalized
 
-def generate_map(num_towns, min_places, max_places):
+class Occupancy:
+    """
+    The occupied cells of a map together with the extent of every row and
+    column. A free cell left of its row's first occupied cell (or right of
+    the last, or above/below its column's extent) has a straight free path
+    out of the map, so it can never be part of an enclosed pocket.
+    """
+    def __init__(self):
+        self.cells = {}
+        self.row_extent = {}
+        self.col_extent = {}
+
+    def __contains__(self, cell):
+        return cell in self.cells
+
+    def add(self, cell, label):
+        r, c = cell
+        self.cells[cell] = label
+        min_c, max_c = self.row_extent.get(r, (c, c))
+        self.row_extent[r] = (min(min_c, c), max(max_c, c))
+        min_r, max_r = self.col_extent.get(c, (r, r))
+        self.col_extent[c] = (min(min_r, r), max(max_r, r))
+
+    def is_outside(self, cell) -> bool:
+        """Whether a free cell has a straight free path out of the map."""
+        r, c = cell
+        row = self.row_extent.get(r)
+        col = self.col_extent.get(c)
+        return (row is None or c < row[0] or c > row[1]) or (col is None or r < col[0] or r > col[1])
+
+    def dock_cell(self, town_cells, rng=random):
+        """
+        A free cell next to one of town_cells that lies outside the map. If
+        the town is enclosed, a cell next to the end of a random row is used
+        instead, which keeps the map connected as well.
+        """
+        candidates = []
+        for r, c in town_cells:
+            for dr, dc in NEIGHBOR_STEPS:
+                neighbor = (r + dr, c + dc)
+                if neighbor not in self.cells and self.is_outside(neighbor):
+                    candidates.append(neighbor)
+        if candidates:
+            return rng.choice(candidates)
+        r = rng.choice(list(self.row_extent))
+        return (r, self.row_extent[r][1] + 1)
+
+def generate_map(num_towns, min_places, max_places, seed=None):
     """
     Generates a map, a dictionary mapping each town to its number of places,
     and returns the normalized grid coordinates of the cell "1:1".
     
     For each town:
       - A random number of places (cells) is chosen between min_places and max_places.
-      - A contiguous shape is generated for these cells using generate_contiguous_shape.
-      - Town 1 is placed arbitrarily at (0, 0); all other towns are docked to a cell
+      - Town 1 is grown from (0, 0); all other towns are docked to a free cell
         adjacent to a previously–placed (parent) town to guarantee connectivity.
-      - The new town’s shape is placed so that it does not overlap any existing cells.
+      - The town is grown from its docking cell into free cells only, so it never
+        overlaps another town. Docking cells have a free path out of the map, so
+        growth always finds enough free cells and no placement is ever retried.
+
+    The same seed always generates the same map.
     
     Returns:
         grid: A 2D list (array of arrays) where each cell is either an empty string ("")
@@ -48,99 +129,50 @@ def generate_map(num_towns, min_places, max_places):
         town_places: A dictionary mapping town number to the number of places.
         start_location: A tuple (x, y) indicating the normalized grid location of "1:1".
     """
-    global_map = {}         # Mapping of (global_row, global_col) to cell label.
-    town_cells_global = {}  # Mapping of town number to a set of global cell coordinates.
+    rng = random.Random(seed)
+    occupancy = Occupancy()
+    town_cells_global = {}  # Mapping of town number to the list of global cell coordinates.
     town_places = {}        # Mapping of town number to the number of places.
     
     # For recording the global coordinate of "1:1"
     town1_first_global = None
 
-    # Create a simple spanning tree to ensure connectivity:
-    # Every town (except town 1) gets a random parent from among the already–placed towns.
-    town_parent = {1: None}
-    for town in range(2, num_towns + 1):
-        parent = random.choice(list(range(1, town)))
-        town_parent[town] = parent
-
-    # Place towns one by one.
+    # Place towns one by one; every town (except town 1) gets a random parent
+    # from among the already–placed towns.
     for town in range(1, num_towns + 1):
         # Choose a random number of places for this town.
-        num_places = random.randint(min_places, max_places)
+        num_places = rng.randint(min_places, max_places)
         town_places[town] = num_places
-        
-        # Generate a contiguous shape for the town.
-        shape = generate_contiguous_shape(num_places)
-        
-        # For town 1, we place it at (0, 0); for other towns, dock them near their parent.
+
         if town == 1:
-            offset = (0, 0)
+            start = (0, 0)
         else:
-            parent = town_parent[town]
-            parent_cells = list(town_cells_global[parent])
-            random.shuffle(parent_cells)
-            placed = False
-            max_attempts = 200
-            attempt = 0
-            while not placed and attempt < max_attempts:
-                attempt += 1
-                # Pick a random cell from the parent's placed cells.
-                pr, pc = random.choice(parent_cells)
-                # Consider its four adjacent neighbors as candidate docking points.
-                neighbors = [(pr - 1, pc), (pr + 1, pc), (pr, pc - 1), (pr, pc + 1)]
-                random.shuffle(neighbors)
-                for nbr in neighbors:
-                    if nbr in global_map:
-                        continue  # Candidate cell is already occupied.
-                    # Try to align the town's shape so that one of its local cells falls on the neighbor.
-                    for (lr, lc) in shape:
-                        offset_candidate = (nbr[0] - lr, nbr[1] - lc)
-                        # Check if placing the entire shape with this offset conflicts with existing cells.
-                        conflict = False
-                        for (r_local, c_local) in shape:
-                            r_global = offset_candidate[0] + r_local
-                            c_global = offset_candidate[1] + c_local
-                            if (r_global, c_global) in global_map:
-                                conflict = True
-                                break
-                        if not conflict:
-                            offset = offset_candidate
-                            placed = True
-                            break
-                    if placed:
-                        break
-            if not placed:
-                raise RuntimeError(f"Could not place town {town} after many attempts.")
-
-        # With the chosen offset, place the town's cells in the global map.
-        placed_cells = set()
-        for i, (r_local, c_local) in enumerate(shape):
-            r_global = offset[0] + r_local
-            c_global = offset[1] + c_local
-            label = f"{town}:{i+1}"  # Label places as "town:place" (places are 1-indexed)
-            global_map[(r_global, c_global)] = label
-            placed_cells.add((r_global, c_global))
-            # Record the location of "1:1" (first cell of town 1)
-            if town == 1 and i == 0:
-                town1_first_global = (r_global, c_global)
-        town_cells_global[town] = placed_cells
+            parent = rng.randint(1, town - 1)
+            start = occupancy.dock_cell(town_cells_global[parent], rng)
+        cells = grow_shape(start, num_places, occupancy, rng)
+
+        # Label places as "town:place" (places are 1-indexed) in row-major order.
+        cells.sort()
+        for i, cell in enumerate(cells):
+            occupancy.add(cell, f"{town}:{i+1}")
+        town_cells_global[town] = cells
+        # Record the location of "1:1" (first cell of town 1)
+        if town == 1:
+            town1_first_global = cells[0]
 
     # Determine the grid boundaries.
-    all_rows = [r for (r, _) in global_map.keys()]
-    all_cols = [c for (_, c) in global_map.keys()]
-    min_r, max_r = min(all_rows), max(all_rows)
-    min_c, max_c = min(all_cols), max(all_cols)
+    min_r, max_r = min(occupancy.row_extent), max(occupancy.row_extent)
+    min_c, max_c = min(occupancy.col_extent), max(occupancy.col_extent)
     num_rows = max_r - min_r + 1
     num_cols = max_c - min_c + 1
 
     # Build the grid as a 2D list with empty strings where no town is placed.
     grid = [["" for _ in range(num_cols)] for _ in range(num_rows)]
-    for (r, c), label in global_map.items():
+    for (r, c), label in occupancy.cells.items():
         grid[r - min_r][c - min_c] = label
 
     # Compute the normalized coordinate of "1:1"
     # (i.e. adjust the global coordinate by the grid's minimum row and col)
-    if town1_first_global is None:
-        raise RuntimeError("Town 1's starting cell ('1:1') was not recorded.")
     start_location = (town1_first_global[1] - min_c + 1, town1_first_global[0] - min_r + 1)
 
     return grid, town_places, start_location
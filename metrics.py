@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    """Process-wide store of counters and histograms keyed by name and labels."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # every observed value by name and labels, only kept when set to a dict
+        # (the benchmark takes its percentiles from them)
+        self.samples = None
+
+    @staticmethod
+    def label_key(labels: dict):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict = None, amount: float = 1):
+        key = self.label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name: str, value: float, labels: dict = None):
+        key = self.label_key(labels)
+        with self.lock:
+            self.counters.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, labels: dict = None, buckets = LATENCY_BUCKETS):
+        key = self.label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+            if self.samples is not None:
+                self.samples.setdefault(name, {}).setdefault(key, []).append(value)
+
+    def get(self, name: str, labels: dict = None) -> float:
+        with self.lock:
+            return self.counters.get(name, {}).get(self.label_key(labels), 0)
+
+    def get_histogram(self, name: str, labels: dict = None) -> Histogram:
+        with self.lock:
+            return self.histograms.get(name, {}).get(self.label_key(labels))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+                for key, value in series.items():
+                    lines.append(f"{name}{format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(key) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in key) + "}"
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+registry = Registry()
+
+class CallRecord:
+    """Measurements of one provider call, filled in while the call runs."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.ttfb = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+
+    def first_byte(self):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.start
+
+    def usage(self, usage):
+        if usage is not None:
+            self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+            self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+@contextmanager
+def track(kind: str, provider: str, model: str, call_site: str):
+    """
+    Record wall time, time to first byte, tokens, retries and failures of a
+    call under chatquest_<kind>_* metrics. Without streaming the first byte
+    is taken to arrive when the call completes.
+    """
+    labels = {'provider': provider, 'model': model or "", 'call_site': call_site or "unknown"}
+    record = CallRecord()
+    try:
+        yield record
+    except asyncio.CancelledError:
+        # e.g. the loser of a hedged request
+        registry.inc(f"chatquest_{kind}_cancelled_total", labels)
+        raise
+    except BaseException:
+        registry.inc(f"chatquest_{kind}_failures_total", labels)
+        raise
+    finally:
+        wall = time.perf_counter() - record.start
+        registry.inc(f"chatquest_{kind}_calls_total", labels)
+        registry.observe(f"chatquest_{kind}_call_seconds", wall, labels)
+        registry.observe(f"chatquest_{kind}_ttfb_seconds", record.ttfb if record.ttfb is not None else wall, labels)
+        if record.retries:
+            registry.inc(f"chatquest_{kind}_retries_total", labels, record.retries)
+        if record.prompt_tokens:
+            registry.inc(f"chatquest_{kind}_prompt_tokens_total", labels, record.prompt_tokens)
+        if record.completion_tokens:
+            registry.inc(f"chatquest_{kind}_completion_tokens_total", labels, record.completion_tokens)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serve the metrics in Prometheus text format from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return server
@@ -1,9 +1,11 @@
 from mistralai import Mistral
 import prompts
-from pprint import pprint
 import httpx
+import logging
 from ai_client import AIClient
 
+logger = logging.getLogger(__name__)
+
 class MistralClient(AIClient):
     def __init__(self, api_key: str):
         super().__init__("Mistral")
@@ -16,8 +18,10 @@ class MistralClient(AIClient):
 
         # Create an HTTP client with the timeout settings
         http_client = httpx.Client(timeout=timeout_settings)
-        self.client = Mistral(api_key=api_key, client=http_client)
+        async_http_client = httpx.AsyncClient(timeout=timeout_settings)
+        self.client = Mistral(api_key=api_key, client=http_client, async_client=async_http_client)
         self.model = "mistral-small-latest"
+        self.deterministic_json = True
 
     def init_chat(self):
         self.messages = [
@@ -46,7 +50,6 @@ class MistralClient(AIClient):
     
     def get_json_response(self, type):
         try:
-            print('get_json_response 1 ...')
             completion = self.client.chat.parse(
                 model=self.model,
                 messages=self.messages,
@@ -55,7 +58,7 @@ class MistralClient(AIClient):
             )
         except Exception as e:
             # One retry attempt
-            print('get_json_response 2 ...')
+            logger.warning('Retrying get_json_response', exc_info=True)
             completion = self.client.chat.parse(
                 model=self.model,
                 messages=self.messages,
@@ -63,11 +66,78 @@ class MistralClient(AIClient):
                 response_format=type
             )
 
-        print('get json_data 1 ...')
         json_data = completion.choices[0].message.content
         self.log_response_json(json_data)
 
         data = type.model_validate_json(json_data)
         self.log_response_object(data)
 
-        return data
\ No newline at end of file
+        return data
+
+    async def aget_response(self):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            response = await self.client.chat.complete_async(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0
+            )
+            call.usage(response.usage)
+
+        text = response.choices[0].message.content
+        self.messages.append({ "role": "assistant", "content": text })
+
+        self.log_response_text(text)
+
+        return text
+
+    async def astream_response(self):
+        await self.acquire_quota()
+        text = ""
+        with self.track_call() as call:
+            stream = await self.client.chat.stream_async(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0
+            )
+            async for event in stream:
+                call.usage(event.data.usage)
+                content = event.data.choices[0].delta.content if event.data.choices else None
+                if isinstance(content, str) and content:
+                    call.first_byte()
+                    text += content
+                    yield content
+
+        self.messages.append({ "role": "assistant", "content": text })
+
+        self.log_response_text(text)
+
+    async def aget_json_response(self, type):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            try:
+                completion = await self.client.chat.parse_async(
+                    model=self.model,
+                    messages=self.messages,
+                    temperature=0,
+                    response_format=type
+                )
+            except Exception:
+                # One retry attempt
+                logger.warning('Retrying aget_json_response', exc_info=True)
+                call.retries += 1
+                completion = await self.client.chat.parse_async(
+                    model=self.model,
+                    messages=self.messages,
+                    temperature=0,
+                    response_format=type
+                )
+            call.usage(completion.usage)
+
+        json_data = completion.choices[0].message.content
+        self.log_response_json(json_data)
+
+        data = type.model_validate_json(json_data)
+        self.log_response_object(data)
+
+        return data
@@ -1,12 +1,16 @@
+import logging
 import os
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import prompts
 from ai_client import AIClient
 
+logger = logging.getLogger(__name__)
+
 class OpenAIClient(AIClient):
     def __init__(self, api_key: str):
         super().__init__("OpenAI")
         self.client = OpenAI(api_key=api_key)
+        self.async_client = AsyncOpenAI(api_key=api_key)
         self.model = os.getenv('OPENAI_MODEL')
 
     def init_chat(self):
@@ -42,7 +46,7 @@ class OpenAIClient(AIClient):
                 timeout=20
             )
         except Exception:
-            print('retrying ...')
+            logger.warning('Retrying get_json_response', exc_info=True)
             completion = self.client.beta.chat.completions.parse(
                 model=self.model,
                 messages=self.messages,
@@ -55,3 +59,68 @@ class OpenAIClient(AIClient):
         self.log_response_object(data)
 
         return data
+
+    async def aget_response(self):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0,
+                timeout=20
+            )
+            call.usage(response.usage)
+
+        text = response.choices[0].message.content
+        self.messages.append({ "role": "assistant", "content": text })
+        return text
+
+    async def astream_response(self):
+        await self.acquire_quota()
+        text = ""
+        with self.track_call() as call:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0,
+                timeout=20,
+                stream=True,
+                stream_options={ "include_usage": True }
+            )
+            async for chunk in stream:
+                call.usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    call.first_byte()
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+
+        self.messages.append({ "role": "assistant", "content": text })
+        self.log_response_text(text)
+
+    async def aget_json_response(self, type):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            try:
+                completion = await self.async_client.beta.chat.completions.parse(
+                    model=self.model,
+                    messages=self.messages,
+                    response_format=type,
+                    temperature=0.9,
+                    timeout=20
+                )
+            except Exception:
+                logger.warning('Retrying aget_json_response', exc_info=True)
+                call.retries += 1
+                completion = await self.async_client.beta.chat.completions.parse(
+                    model=self.model,
+                    messages=self.messages,
+                    response_format=type,
+                    temperature=1.0,
+                    timeout=20
+                )
+            call.usage(completion.usage)
+
+        data = completion.choices[0].message.parsed
+        self.log_response_object(data)
+
+        return data
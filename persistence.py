@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from copy import deepcopy
+from typing import Dict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from chunks import WorldChunks
+from world import World, WorldMap, WorldStatus, Town, Place, NPC, Point, GenImage
+
+logger = logging.getLogger(__name__)
+
+class SQLiteDatabase:
+    """A SQLite connection shared between the event loop and worker threads."""
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+
+    def execute_script(self, statements):
+        """Run a list of (sql, params) statements in one transaction."""
+        with self.lock:
+            with self.db:
+                for sql, params in statements:
+                    self.db.execute(sql, params)
+
+    def query(self, sql: str, params = ()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+class SQLitePersistence(BasePersistence):
+    """
+    PTB persistence storing bot_data in SQLite, one row per top-level key.
+    Only keys whose pickled value changed since the last write are written.
+    """
+    def __init__(self, database: SQLiteDatabase, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.database = database
+        self.database.execute_script([
+            ("CREATE TABLE IF NOT EXISTS bot_data (key BLOB PRIMARY KEY, value BLOB NOT NULL)", ()),
+        ])
+        self.bot_data = None
+        self.written: Dict[bytes, bytes] = {}
+
+    async def get_bot_data(self):
+        if self.bot_data is None:
+            rows = await asyncio.to_thread(self.database.query, "SELECT key, value FROM bot_data")
+            self.bot_data = {pickle.loads(key): pickle.loads(value) for key, value in rows}
+            self.written = {key: value for key, value in rows}
+        return deepcopy(self.bot_data)
+
+    async def update_bot_data(self, data):
+        statements = []
+        keys = set()
+        for key, value in data.items():
+            key_blob = pickle.dumps(key)
+            value_blob = pickle.dumps(value)
+            keys.add(key_blob)
+            if self.written.get(key_blob) != value_blob:
+                statements.append(("INSERT OR REPLACE INTO bot_data (key, value) VALUES (?, ?)", (key_blob, value_blob)))
+                self.written[key_blob] = value_blob
+        for key_blob in [key_blob for key_blob in self.written if key_blob not in keys]:
+            statements.append(("DELETE FROM bot_data WHERE key = ?", (key_blob,)))
+            del self.written[key_blob]
+
+        self.bot_data = data
+        if statements:
+            logger.debug("Writing bot_data", extra={'changed_keys': len(statements)})
+            await asyncio.to_thread(self.database.execute_script, statements)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+    # only bot_data is persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+class WorldStore:
+    """
+    Stores worlds in SQLite, one row per entity (world header, map, town
+    image, place, NPC, NPC group image) with images and the map's planes as
+    blobs. save_world only writes the entities whose fingerprint changed
+    since they were last written or loaded.
+    """
+    def __init__(self, database: SQLiteDatabase):
+        self.database = database
+        self.database.execute_script([
+            ("CREATE TABLE IF NOT EXISTS worlds (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)", ()),
+            ("CREATE TABLE IF NOT EXISTS maps (chat_id INTEGER PRIMARY KEY, width INTEGER NOT NULL, "
+             "height INTEGER NOT NULL, towns BLOB NOT NULL, places BLOB NOT NULL, exits BLOB NOT NULL)", ()),
+            ("CREATE TABLE IF NOT EXISTS town_images (chat_id INTEGER, town_idx INTEGER, data BLOB, "
+             "PRIMARY KEY (chat_id, town_idx))", ()),
+            ("CREATE TABLE IF NOT EXISTS places (chat_id INTEGER, place_key TEXT, description TEXT NOT NULL, "
+             "PRIMARY KEY (chat_id, place_key))", ()),
+            ("CREATE TABLE IF NOT EXISTS npcs (chat_id INTEGER, place_key TEXT, idx INTEGER, "
+             "description TEXT NOT NULL, appearance TEXT NOT NULL, PRIMARY KEY (chat_id, place_key, idx))", ()),
+            ("CREATE TABLE IF NOT EXISTS npc_images (chat_id INTEGER, place_key TEXT, data BLOB, dirty INTEGER, "
+             "PRIMARY KEY (chat_id, place_key))", ()),
+        ])
+        # chat_id -> entity key -> fingerprint of the stored value
+        self.fingerprints: Dict[int, Dict[tuple, int]] = {}
+
+    def entities(self, chat_id: int, world: World):
+        """Yield (entity key, fingerprint, write statement) for every entity of a world."""
+        current_town_idx = world.towns.index(world.current_town) if world.current_town in (world.towns or []) else None
+        header = json.dumps({
+            'description': world.description,
+            'towns': [town.model_dump() for town in world.towns or []],
+            'location': list(world.location) if world.location else None,
+            'selected_npc_index': world.selected_npc_index,
+            'status': world.status.name,
+            'current_town_idx': current_town_idx,
+            'chunks': world.chunks.to_json() if world.chunks is not None else None,
+        })
+        yield ('world',), hash(header), (
+            "INSERT OR REPLACE INTO worlds (chat_id, data) VALUES (?, ?)", (chat_id, header))
+
+        if world.map is not None:
+            # the planes are only copied out when the map changed
+            yield ('map',), world.map.revision, lambda world_map=world.map: (
+                "INSERT OR REPLACE INTO maps (chat_id, width, height, towns, places, exits) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, world_map.width, world_map.height, *world_map.to_planes()))
+
+        for town_idx, image in enumerate(world.towns_images, start=1):
+            # bytes cache their hash, so fingerprinting an unchanged image is cheap
+            yield ('town_image', town_idx), hash(image), (
+                "INSERT OR REPLACE INTO town_images (chat_id, town_idx, data) VALUES (?, ?, ?)", (chat_id, town_idx, image))
+
+        for place_key, place in world.places_dict.items():
+            yield ('place', place_key), hash(place.description), (
+                "INSERT OR REPLACE INTO places (chat_id, place_key, description) VALUES (?, ?, ?)",
+                (chat_id, place_key, place.description))
+
+        for place_key, npc_list in world.npcs_dict.items():
+            for idx, npc in enumerate(npc_list):
+                yield ('npc', place_key, idx), hash((npc.description, npc.appearance)), (
+                    "INSERT OR REPLACE INTO npcs (chat_id, place_key, idx, description, appearance) VALUES (?, ?, ?, ?, ?)",
+                    (chat_id, place_key, idx, npc.description, npc.appearance))
+
+        for place_key, gen_image in world.places_npc_images_dict.items():
+            data, dirty = (gen_image.data, gen_image.dirty) if gen_image is not None else (None, None)
+            yield ('npc_image', place_key), hash((data, dirty)), (
+                "INSERT OR REPLACE INTO npc_images (chat_id, place_key, data, dirty) VALUES (?, ?, ?, ?)",
+                (chat_id, place_key, data, dirty))
+
+    def collect_changes(self, chat_id: int, world: World):
+        """Return the statements writing every changed entity and remember the new fingerprints."""
+        previous = self.fingerprints.get(chat_id, {})
+        current = {}
+        statements = []
+        for key, fingerprint, statement in self.entities(chat_id, world):
+            current[key] = fingerprint
+            if previous.get(key) != fingerprint:
+                statements.append(statement() if callable(statement) else statement)
+
+        for key in previous.keys() - current.keys():
+            if key[0] == 'npc':
+                statements.append(("DELETE FROM npcs WHERE chat_id = ? AND place_key = ? AND idx = ?", (chat_id, key[1], key[2])))
+            elif key[0] == 'place':
+                statements.append(("DELETE FROM places WHERE chat_id = ? AND place_key = ?", (chat_id, key[1])))
+            elif key[0] == 'npc_image':
+                statements.append(("DELETE FROM npc_images WHERE chat_id = ? AND place_key = ?", (chat_id, key[1])))
+            elif key[0] == 'map':
+                statements.append(("DELETE FROM maps WHERE chat_id = ?", (chat_id,)))
+            elif key[0] == 'town_image':
+                statements.append(("DELETE FROM town_images WHERE chat_id = ? AND town_idx = ?", (chat_id, key[1])))
+
+        self.fingerprints[chat_id] = current
+        return statements
+
+    async def save_world(self, chat_id: int, world: World):
+        # fingerprints are collected on the event loop, the writes happen in a worker thread
+        statements = self.collect_changes(chat_id, world)
+        if statements:
+            logger.debug("Saving world", extra={'chat_id': chat_id, 'changed_entities': len(statements)})
+            try:
+                await asyncio.to_thread(self.database.execute_script, statements)
+            except Exception:
+                # forget what was stored so that the next save writes everything again
+                self.fingerprints.pop(chat_id, None)
+                raise
+
+    async def delete_world(self, chat_id: int):
+        self.fingerprints.pop(chat_id, None)
+        await asyncio.to_thread(self.database.execute_script, [
+            (f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+            for table in ['worlds', 'maps', 'town_images', 'places', 'npcs', 'npc_images']
+        ])
+
+    def read_world(self, chat_id: int) -> World:
+        rows = self.database.query("SELECT data FROM worlds WHERE chat_id = ?", (chat_id,))
+        if not rows:
+            return None
+        header = json.loads(rows[0][0])
+
+        world = World()
+        world.description = header['description']
+        world.init_towns([Town(**town) for town in header['towns']])
+        maps = self.database.query("SELECT width, height, towns, places, exits FROM maps WHERE chat_id = ?", (chat_id,))
+        if maps:
+            world.map = WorldMap.from_planes(*maps[0])
+        elif header.get('map') is not None:
+            # worlds stored before the map had its own table keep the label grid in the header
+            world.map = WorldMap.from_grid(header['map'])
+        world.location = Point(*header['location']) if header['location'] else None
+        world.selected_npc_index = header['selected_npc_index']
+        world.status = WorldStatus[header['status']]
+        if header['current_town_idx'] is not None:
+            world.current_town = world.towns[header['current_town_idx']]
+        if header.get('chunks') is not None:
+            world.chunks = WorldChunks.from_json(header['chunks'])
+
+        for town_idx, data in self.database.query("SELECT town_idx, data FROM town_images WHERE chat_id = ?", (chat_id,)):
+            world.towns_images[town_idx - 1] = data
+        for place_key, description in self.database.query(
+                "SELECT place_key, description FROM places WHERE chat_id = ? ORDER BY rowid", (chat_id,)):
+            world.places_dict[place_key] = Place(description=description)
+            world.npcs_dict[place_key] = []
+        for place_key, _, description, appearance in self.database.query(
+                "SELECT place_key, idx, description, appearance FROM npcs WHERE chat_id = ? ORDER BY place_key, idx", (chat_id,)):
+            world.npcs_dict.setdefault(place_key, []).append(NPC(description=description, appearance=appearance))
+        for place_key, data, dirty in self.database.query(
+                "SELECT place_key, data, dirty FROM npc_images WHERE chat_id = ?", (chat_id,)):
+            world.places_npc_images_dict[place_key] = None if data is None else GenImage(data=data, dirty=bool(dirty))
+
+        # a town is ready once its places were stored
+        for town_idx in world.towns_ready:
+            if any(place_key.startswith(f"{town_idx}:") for place_key in world.places_dict):
+                world.set_town_ready(town_idx)
+        return world
+
+    async def load_world(self, chat_id: int) -> World:
+        world = await asyncio.to_thread(self.read_world, chat_id)
+        if world is not None:
+            # what was just loaded is what is stored
+            self.collect_changes(chat_id, world)
+        return world
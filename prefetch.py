@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Set
+
+import scheduler
+import worldgen
+from client_factory import create_client
+from world import World, Point, GenImage
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of speculatively generated NPC images per chat that the
+# player has not looked at with /who. A hit frees up budget again, so a chat
+# that never uses /who stops prefetching after this many images.
+PREFETCH_BUDGET = int(os.getenv('PREFETCH_BUDGET', '8'))
+
+class NPCImagePrefetcher:
+    """
+    Generates the NPC group images of the places next to the player in the
+    background so that /who is usually served from places_npc_images_dict.
+    """
+    def __init__(self, metaprompter_provider: str, budget: int = PREFETCH_BUDGET):
+        self.metaprompter_provider = metaprompter_provider
+        self.budget = budget
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.unseen: Set[str] = set()
+
+    def adjacent_place_keys(self, world: World):
+        x, y = world.location
+        for location in [Point(x, y - 1), Point(x, y + 1), Point(x + 1, y), Point(x - 1, y)]:
+            if world.can_move(location) and world.town_ready(world.get_town_idx(location)):
+                yield world.map.place_key_at(location)
+
+    def schedule(self, world: World):
+        """Start generating the dirty NPC images of the places one step away."""
+        for place_key in self.adjacent_place_keys(world):
+            if len(self.tasks) + len(self.unseen) >= self.budget:
+                logger.debug("Prefetch budget exhausted")
+                return
+
+            gen_image = world.places_npc_images_dict.get(place_key)
+            if gen_image is None or not gen_image.dirty or place_key in self.tasks:
+                continue
+
+            logger.info("Prefetching NPC image", extra={'place_key': place_key})
+            self.tasks[place_key] = asyncio.create_task(self.generate(world, place_key, gen_image))
+
+    async def generate(self, world: World, place_key: str, gen_image: GenImage):
+        scheduler.set_priority(scheduler.Priority.PREFETCH)
+        try:
+            npcs = world.npcs_dict[place_key]
+            _, npcs_text = worldgen.get_npcs_text(npcs)
+
+            # each prefetch gets its own conversation
+            metaprompter = create_client(self.metaprompter_provider)
+            data = await worldgen.get_npcs_image(metaprompter, npcs)
+
+            # discard the result if the NPCs changed while it was generated
+            if data is not None and worldgen.get_npcs_text(npcs)[1] == npcs_text:
+                gen_image.data = data
+                gen_image.dirty = False
+                self.unseen.add(place_key)
+        except Exception as e:
+            logger.warning("Prefetch failed: %s", e, extra={'place_key': place_key})
+        finally:
+            del self.tasks[place_key]
+
+    async def wait(self, place_key: str):
+        """Wait for a prefetch of the given place that is still in flight."""
+        task = self.tasks.get(place_key)
+        if task is not None:
+            await asyncio.shield(task)
+
+    def seen(self, place_key: str):
+        self.unseen.discard(place_key)
@@ -12,12 +12,36 @@ Generate a creative description for a unique fantasy world with a theme of: {}.
 Keep the description short and simple and within 3 sentences.
 """
 
+# stands in for the world description while it is still being created
+THEME_WORLD = "A unique fantasy world with a theme of: {}."
+
 CREATE_TOWNS = """
 Describe the name and descriptions of {} towns set in this world.
 Keep the description short and simple and within 3 sentences.
+
+<WORLD>
+{}
+</WORLD>
+
 Extract the name and description of the towns.
 """
 
+CREATE_MORE_TOWNS = """
+Describe the name and descriptions of {} new towns set in this world.
+Keep the description short and simple and within 3 sentences.
+Give the new towns names different from the towns the world already has.
+
+<WORLD>
+{}
+</WORLD>
+
+<EXISTING_TOWNS>
+{}
+</EXISTING_TOWNS>
+
+Extract the name and description of the new towns.
+"""
+
 CREATE_PLACES = """
 Describe {} places in this world and town. Do not give names for the places.
 One of the places should be the center of the town. Some of the places can be simple roads.
@@ -34,6 +58,23 @@ The response should start with 'You are in' as if describing to the player the p
 Extract the description of the places.
 """
 
+CREATE_WORLD_BLUEPRINT = """
+Create a unique fantasy world with a theme of: {}.
+Describe the world in 3 sentences.
+Then describe the name and description of each of the following towns set in this world, each within 3 sentences.
+For each town, describe exactly the given number of places in the town. Do not give names for the places.
+One of the places should be the center of the town. Some of the places can be simple roads.
+Each place description should start with 'You are in' as if describing to the player the place they are in.
+For each town, also describe exactly the given number of characters that might be found in the town and what they are doing at the moment, within 1 sentence per character.
+Also describe the physical appearance of the characters in 8-10 sentences. Mention the style and color of the hair, the color of skin, and style and color of clothing.
+
+<TOWNS>
+{}
+</TOWNS>
+
+Extract the world description and the towns with their places and characters.
+"""
+
 CREATE_TOWN_IMAGE = """
 Setting: {}
 A vibrant 16-bit SNES-era pixel art town. Hand-crafted pixel details, NPCs walking, dynamic lighting with soft gradients, bright blue sky. Retro dithering effect, warm color palette, charming RPG town atmosphere, top-down perspective.
@@ -44,6 +85,10 @@ Describe {} characters that might be found in this town and what they are doing
 Keep the description simple and within 1 sentence per character.
 Also describe the physical appearance of the characters in 8-10 sentences. Mention the style and color of the hair, the color of skin, and style and color of clothing.
 
+<WORLD>
+{}
+</WORLD>
+
 <TOWN>
 {}
 </TOWN>
@@ -106,7 +151,60 @@ The player performs an action on the NPC. Describe what happens. Keep the descri
 </NPC>
 """
 
+ACTION_NPC_OUTCOME = """
+The player performs an action on the NPC. Describe what happens in the narration. Keep the narration within 4 sentences.
+Then change the following for the NPC given what happened.
+description - keep to 1 sentence
+appearance - change only if it is affected by what happened, keep to 10 sentences
+Keep the wording simple.
+
+<ACTION>
+{}
+</ACTION>
+
+<NPC>
+{}
+</NPC>
+
+Previous appearance:
+{}
+"""
+
+ATTACK_NPC_OUTCOME = """
+The player attackes the NPC. Describe what happens in the narration following the rules. Keep the narration short and simple and within 1 sentence.
+Then change the following for the NPC given what happened.
+description - keep to 1 sentence
+appearance - keep to 10 sentences
+Keep the wording simple.
+
+<RULES>
+There is a 50% channce the NPC defends itself.
+There is a 50% channce the NPC is hurt.
+If the NPC is already very hurt and is attacked, the NPC will die.
+</RULES>
+
+<NPC>
+{}
+</NPC>
+
+Previous appearance:
+{}
+"""
+
 CREATE_PLACE_IMAGE = """
 Draw all these {} characters together:
 {}
-"""
\ No newline at end of file
+"""
+SUMMARIZE_CONVERSATION = """
+Summarize what has happened so far in this conversation between the player and the characters.
+Keep everything that matters for the story, such as what the player did and how the characters changed.
+Keep the summary within 5 sentences.
+
+<PREVIOUS_SUMMARY>
+{}
+</PREVIOUS_SUMMARY>
+
+<CONVERSATION>
+{}
+</CONVERSATION>
+"""
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict
+
+class ResponseCache(ABC):
+    """
+    Interface of the response caches that can be attached to an AIClient.
+    get and put may block; clients call them from a worker thread.
+    """
+    @abstractmethod
+    def get(self, key: str) -> str:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, value: str):
+        pass
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages, type) -> str:
+        normalized_messages = [
+            {"role": message["role"], "content": message["content"].strip()}
+            for message in messages
+        ]
+        params = [provider, model, normalized_messages, type.model_json_schema()]
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    Response cache stored in a SQLite database.
+
+    Entries older than ttl seconds are ignored and removed; once there are
+    more than max_entries, the least recently used entries are removed.
+    Reads only take note of when an entry was used, the next put writes it
+    so that a hit never waits for the write lock.
+    """
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # key -> time of the hits not written yet
+        self.accessed: Dict[str, float] = {}
+        # the worker processes share the cache; WAL lets them read while one
+        # writes and a writer waits up to timeout seconds for the others
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.db.commit()
+
+    def get(self, key: str) -> str:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM responses WHERE key = ? AND created_at >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self.db.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, accessed_key) for accessed_key, accessed_at in self.accessed.items()]
+            )
+            self.accessed.clear()
+            self.evict(now)
+            self.db.commit()
+
+    def evict(self, now: float):
+        self.db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+# process-wide cache shared by the clients from client_factory,
+# disabled when RESPONSE_CACHE_PATH is empty
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', '.response_cache.sqlite')
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '10000'))
+
+default_cache = None
+
+def get_default_cache() -> ResponseCache:
+    global default_cache
+    if default_cache is None and RESPONSE_CACHE_PATH:
+        default_cache = SQLiteResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+    return default_cache
@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Dict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Rate limits are configured per provider, e.g. RATE_LIMIT_MISTRAL_RPM=60 and
+# RATE_LIMIT_MISTRAL_TPM=500000 (provider names as in AIClient.name, image
+# generation is "TOGETHER_IMAGES"). Providers without limits are not queued.
+
+# seconds of the per-minute rate that may be used in one burst
+RATE_LIMIT_BURST_SECONDS = float(os.getenv('RATE_LIMIT_BURST_SECONDS', '10'))
+
+# number of processes sharing the configured limits, see share_rate_limits
+rate_limit_shares = 1
+
+class Priority(IntEnum):
+    # a player waiting for an answer in a running game
+    INTERACTIVE = 0
+    # a player waiting for a new world or an unexplored chunk
+    CREATION = 1
+    PREFETCH = 2
+    BULK = 3
+
+# priority of the calls made by the current task; tasks inherit it from the
+# task that created them
+current_priority: contextvars.ContextVar = contextvars.ContextVar('priority', default=Priority.INTERACTIVE)
+
+def set_priority(priority: Priority):
+    """Set the priority of every provider call of the current task and the tasks it creates."""
+    current_priority.set(priority)
+
+@contextmanager
+def priority(priority: Priority):
+    """Set the priority of the provider calls made inside the block and of the tasks it creates."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = RATE_LIMIT_BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount can be taken; amounts above the capacity only need a full bucket."""
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+class ProviderLimiter:
+    """
+    Admits calls to one provider within its requests/min and tokens/min
+    buckets. Calls that have to wait are admitted strictly by priority,
+    then in arrival order.
+    """
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # heap of (priority, arrival, tokens, future)
+        self.waiting = []
+        self.arrivals = itertools.count()
+        self.dispatcher: asyncio.Task = None
+
+    def delay(self, tokens: int) -> float:
+        return max(
+            self.requests.delay(1) if self.requests else 0,
+            self.tokens.delay(tokens) if self.tokens else 0
+        )
+
+    def take(self, tokens: int):
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+
+    def update_depth(self):
+        depths = {priority: 0 for priority in Priority}
+        for priority, _, _, future in self.waiting:
+            if not future.done():
+                depths[priority] += 1
+        for priority, depth in depths.items():
+            metrics.registry.set("chatquest_scheduler_queue_depth", depth,
+                                 {'provider': self.name, 'priority': priority.name.lower()})
+
+    async def acquire(self, tokens: int, priority: Priority):
+        start = time.perf_counter()
+        if not self.waiting and self.delay(tokens) == 0:
+            self.take(tokens)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (priority, next(self.arrivals), tokens, future))
+            self.update_depth()
+            if self.dispatcher is None or self.dispatcher.done():
+                self.dispatcher = asyncio.create_task(self.dispatch())
+            try:
+                await future
+            finally:
+                # a cancelled waiter is skipped by the dispatcher
+                future.cancel()
+                self.update_depth()
+
+        metrics.registry.observe("chatquest_scheduler_wait_seconds", time.perf_counter() - start,
+                                 {'provider': self.name, 'priority': priority.name.lower()})
+
+    async def dispatch(self):
+        while self.waiting:
+            _, _, tokens, future = self.waiting[0]
+            if future.done():
+                heapq.heappop(self.waiting)
+                continue
+            delay = self.delay(tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self.waiting)
+            self.take(tokens)
+            future.set_result(None)
+
+limiters: Dict[str, ProviderLimiter] = {}
+
+def share_rate_limits(processes: int):
+    """
+    Give this process its share of the configured limits when that many
+    processes call the providers (e.g. the sharding workers), so that
+    together they stay within the limits. The burst shrinks with the rate.
+    """
+    global rate_limit_shares
+    rate_limit_shares = processes
+    limiters.clear()
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    """The process-wide limiter of a provider, or None if it has no limits."""
+    key = provider.upper()
+    if key not in limiters:
+        requests_per_minute = float(os.getenv(f'RATE_LIMIT_{key}_RPM', '0')) / rate_limit_shares
+        tokens_per_minute = float(os.getenv(f'RATE_LIMIT_{key}_TPM', '0')) / rate_limit_shares
+        limiters[key] = None
+        if requests_per_minute or tokens_per_minute:
+            limiters[key] = ProviderLimiter(provider, requests_per_minute, tokens_per_minute)
+            logger.info("Rate limiting provider", extra={
+                'provider': provider, 'rpm': requests_per_minute, 'tpm': tokens_per_minute})
+    return limiters[key]
+
+async def acquire(provider: str, tokens: int = 0):
+    """Wait until a call of about this many tokens may be sent to the provider."""
+    limiter = get_limiter(provider)
+    if limiter is not None:
+        await limiter.acquire(tokens, current_priority.get())
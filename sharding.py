@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import zlib
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+def shard_for(chat_id, workers: int) -> int:
+    """Stable partition of chat ids over the workers."""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % workers
+
+def check_shards(db_path: str, workers: int):
+    """
+    Record how many workers the worlds under db_path are sharded over and
+    refuse to start with a different number: the chats would be dispatched
+    to workers whose databases don't have their worlds.
+    """
+    if not db_path:
+        return
+    db = sqlite3.connect(db_path)
+    try:
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS shards (workers INTEGER NOT NULL)")
+            row = db.execute("SELECT workers FROM shards").fetchone()
+            if row is None:
+                # databases from before the count was recorded
+                stored = 0
+                while os.path.exists(f"{db_path}.w{stored}"):
+                    stored += 1
+                if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'worlds'").fetchone():
+                    stored = 1
+                stored = stored or workers
+                db.execute("INSERT INTO shards (workers) VALUES (?)", (stored,))
+            else:
+                stored = row[0]
+    finally:
+        db.close()
+    if stored != workers:
+        raise RuntimeError(f"The worlds in {db_path} are sharded over {stored} workers, WORKERS is {workers}")
+
+def worker_main(worker_idx: int, workers: int, update_queue: multiprocessing.Queue, metrics_port: int):
+    """Entry point of a worker process."""
+    # Ctrl-C reaches the whole process group; the workers stop when the front
+    # sends them None, after handling what is already queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import chatquest
+    import imaging
+    import logs
+    import metrics
+    import scheduler
+
+    logs.setup_logging()
+    # the provider rate limits and the image cache's size hold for all workers together
+    scheduler.share_rate_limits(workers)
+    if imaging.image_cache is not None:
+        imaging.image_cache.max_bytes //= workers
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    asyncio.run(run_worker(chatquest, worker_idx, update_queue))
+
+async def run_worker(chatquest, worker_idx: int, update_queue: multiprocessing.Queue):
+    # every worker keeps its own bot_data and world store; check_shards keeps
+    # the number of workers, and so the worker of each chat, the same
+    db_path = f"{chatquest.DB_PATH}.w{worker_idx}" if chatquest.DB_PATH else ""
+    application = chatquest.build_application(db_path=db_path, with_updater=False)
+
+    async with application:
+        await application.start()
+        logger.info("Worker started", extra={'worker': worker_idx})
+        while True:
+            data = await asyncio.to_thread(update_queue.get)
+            if data is None:
+                break
+            update = Update.de_json(json.loads(data), application.bot)
+            await application.update_queue.put(update)
+        await application.stop()
+        # only run_polling and run_webhook call post_stop themselves
+        if application.post_stop is not None:
+            await application.post_stop(application)
+    logger.info("Worker stopped", extra={'worker': worker_idx})
+
+def run_front(token: str, workers: int, metrics_port: int = 0):
+    """
+    Poll Telegram in this process and dispatch every update over a queue to
+    the worker process owning its chat.
+    """
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(
+            target=worker_main,
+            args=(worker_idx, workers, queues[worker_idx], metrics_port + worker_idx + 1 if metrics_port else 0),
+            name=f"chatquest-worker-{worker_idx}",
+            daemon=True
+        )
+        for worker_idx in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id if update.effective_chat is not None else 0
+        queues[shard_for(chat_id, workers)].put(update.to_json())
+
+    async def stop_workers(application: Application):
+        for update_queue in queues:
+            update_queue.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, 10)
+
+    application = Application.builder().token(token).post_stop(stop_workers).build()
+    application.add_handler(TypeHandler(Update, dispatch))
+
+    if metrics_port:
+        import metrics
+        metrics.start_http_server(metrics_port)
+
+    logger.info("ChatQuest front starting", extra={'workers': workers})
+    # SIGINT and SIGTERM stop polling and then the workers
+    application.run_polling()
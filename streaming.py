@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# minimum seconds between two edits of a streamed message; Telegram allows
+# roughly one message or edit per second in a chat
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+# characters that have to arrive before the message is first posted
+STREAM_MIN_CHARS = int(os.getenv('STREAM_MIN_CHARS', '40'))
+# Telegram's maximum message length; longer text continues in a new message
+MAX_MESSAGE_CHARS = 4096
+
+class MessageStream:
+    """
+    Shows text in a chat while it is generated: the message is posted once
+    the first STREAM_MIN_CHARS characters arrived and then edited with the
+    text so far at most every STREAM_EDIT_INTERVAL seconds.
+    """
+    def __init__(self, bot, chat_id: int, interval: float = STREAM_EDIT_INTERVAL, min_chars: int = STREAM_MIN_CHARS):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.min_chars = min_chars
+        # text of the messages already completed and of the current one
+        self.done_text = ""
+        self.text = ""
+        self.message_id = None
+        self.shown = ""
+        self.next_edit = 0.0
+
+    async def write(self, chunk: str):
+        self.text += chunk
+        while len(self.text) > MAX_MESSAGE_CHARS:
+            await self.split()
+        if self.message_id is None and len(self.text.strip()) < self.min_chars:
+            return
+        if time.monotonic() >= self.next_edit:
+            await self.show()
+
+    async def split(self):
+        """Complete the current message at a line or word break and start a new one."""
+        cut = self.text.rfind("\n", 0, MAX_MESSAGE_CHARS)
+        if cut <= 0:
+            cut = self.text.rfind(" ", 0, MAX_MESSAGE_CHARS)
+        if cut <= 0:
+            cut = MAX_MESSAGE_CHARS
+        head, self.text = self.text[:cut], self.text[cut:].lstrip()
+        await self.show(head, force=True)
+        self.done_text += head + "\n"
+        self.message_id = None
+        self.shown = ""
+
+    async def show(self, text: str = None, force: bool = False):
+        text = (self.text if text is None else text).strip()
+        if not text or text == self.shown:
+            return
+        if force:
+            # the final edit waits for its turn instead of being skipped
+            await asyncio.sleep(max(0.0, self.next_edit - time.monotonic()))
+        try:
+            if self.message_id is None:
+                message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                self.message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id)
+            self.shown = text
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.info("Streaming throttled by Telegram", extra={'chat_id': self.chat_id, 'retry_after': retry_after})
+            self.next_edit = time.monotonic() + retry_after
+            if force:
+                await asyncio.sleep(retry_after)
+                await self.show(text, force)
+            return
+        except BadRequest as e:
+            # editing a message to the same text is rejected
+            if "not modified" not in str(e):
+                raise
+        self.next_edit = time.monotonic() + self.interval
+
+    async def close(self) -> str:
+        """Show the complete text and return it."""
+        await self.show(force=True)
+        return self.done_text + self.text
+
+async def stream_to_chat(bot, chat_id: int, chunks) -> str:
+    """Post the chunks of an async iterator to the chat as they arrive and return the full text."""
+    stream = MessageStream(bot, chat_id)
+    async for chunk in chunks:
+        await stream.write(chunk)
+    return await stream.close()
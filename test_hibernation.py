@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+from chatlock import ChatLocks
+from hibernation import WorldHibernator
+from world import World
+
+def attach_clients(world: World):
+    pass
+
+def started_world() -> World:
+    world = World()
+    world.description = "A foggy coast"
+    world.set_started()
+    return world
+
+def test_concurrent_enforce(tmp_path):
+    hibernator = WorldHibernator(attach_clients, str(tmp_path), max_bytes=0, idle_seconds=0, chat_locks=ChatLocks())
+    world_dict = {1: started_world(), 2: started_world(), 3: started_world()}
+
+    # the second enforce is still writing world 2 when the first one has
+    # already hibernated world 3, which the second one also selected
+    write = hibernator.write
+    def slow_write(chat_id, state):
+        time.sleep(0.1 if chat_id == 2 else 0)
+        write(chat_id, state)
+    hibernator.write = slow_write
+
+    async def enforce_twice():
+        await asyncio.gather(hibernator.enforce(world_dict), hibernator.enforce(world_dict))
+    asyncio.run(enforce_twice())
+
+    assert world_dict == {}
+    assert all(hibernator.hibernated(chat_id) for chat_id in (1, 2, 3))
@@ -0,0 +1,35 @@
+import asyncio
+import pickle
+
+from history import ChatHistory
+
+def append_all(history: ChatHistory, entries):
+    async def append():
+        for entry in entries:
+            await history.append(entry)
+    asyncio.run(append())
+
+def test_spill(tmp_path):
+    history = ChatHistory(1, max_in_memory=2, directory=str(tmp_path))
+    append_all(history, [{'message': str(i)} for i in range(5)])
+    assert len(history.recent) == 2
+    assert len(history) == 5
+    assert [entry['message'] for entry in history] == ['0', '1', '2', '3', '4']
+    assert asyncio.run(history.last(3)) == [{'message': '2'}, {'message': '3'}, {'message': '4'}]
+
+def test_nothing_in_memory(tmp_path):
+    history = ChatHistory(1, max_in_memory=0, directory=str(tmp_path))
+    append_all(history, [{'message': str(i)} for i in range(3)])
+    assert len(history.recent) == 0
+    assert [entry['message'] for entry in history] == ['0', '1', '2']
+
+def test_spilled_is_counted_from_the_file(tmp_path):
+    history = ChatHistory(1, max_in_memory=2, directory=str(tmp_path))
+    append_all(history, [{'message': str(i)} for i in range(3)])
+    state = pickle.dumps(history)
+
+    # the bot stopped after spilling another entry but before bot_data was stored
+    append_all(history, [{'message': '3'}])
+    loaded = pickle.loads(state)
+    assert len(loaded) == 2 + 2
+    assert [entry['message'] for entry in loaded][:2] == ['0', '1']
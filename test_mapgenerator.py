@@ -0,0 +1,46 @@
+from collections import deque
+
+import pytest
+
+import mapgenerator
+
+def cells_by_town(grid):
+    towns = {}
+    for y, row in enumerate(grid):
+        for x, cell in enumerate(row):
+            if cell != '':
+                town_idx, place_idx = (int(part) for part in cell.split(':'))
+                towns.setdefault(town_idx, {})[(x, y)] = place_idx
+    return towns
+
+def connected(cells) -> bool:
+    cells = set(cells)
+    start = next(iter(cells))
+    seen = {start}
+    queue = deque([start])
+    while queue:
+        x, y = queue.popleft()
+        for dx, dy in mapgenerator.NEIGHBOR_STEPS:
+            neighbor = (x + dx, y + dy)
+            if neighbor in cells and neighbor not in seen:
+                seen.add(neighbor)
+                queue.append(neighbor)
+    return seen == cells
+
+@pytest.mark.parametrize('seed', range(20))
+def test_generate_map(seed):
+    grid, town_places, start_location = mapgenerator.generate_map(5, 3, 5, seed=seed)
+    towns = cells_by_town(grid)
+
+    assert sorted(towns) == [1, 2, 3, 4, 5]
+    for town_idx, places in towns.items():
+        assert 3 <= town_places[town_idx] <= 5
+        assert sorted(places.values()) == list(range(1, town_places[town_idx] + 1))
+        assert connected(places), f"town {town_idx} is not contiguous"
+
+    assert connected([cell for places in towns.values() for cell in places])
+    x, y = start_location
+    assert grid[y - 1][x - 1] == "1:1"
+
+def test_generate_map_is_reproducible():
+    assert mapgenerator.generate_map(5, 3, 5, seed=7) == mapgenerator.generate_map(5, 3, 5, seed=7)
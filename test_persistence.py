@@ -0,0 +1,43 @@
+import asyncio
+
+from persistence import SQLiteDatabase, WorldStore
+from world import World, WorldMap, Town, Place, Point, WorldStatus
+
+def make_world() -> World:
+    world = World()
+    world.description = "A foggy coast"
+    world.init_towns([Town(name="Saltmarsh", description="fishing village")])
+    world.map = WorldMap.from_grid([['1:1', '1:2'], ['', '1:3']])
+    world.location = Point(1, 1)
+    for place_idx in range(1, 4):
+        world.places_dict[f"1:{place_idx}"] = Place(description=f"place {place_idx}")
+        world.npcs_dict[f"1:{place_idx}"] = []
+        world.places_npc_images_dict[f"1:{place_idx}"] = None
+    world.set_town_ready(1)
+    world.set_started()
+    return world
+
+def test_save_and_load_world():
+    store = WorldStore(SQLiteDatabase(":memory:"))
+    world = make_world()
+    asyncio.run(store.save_world(1, world))
+
+    loaded = WorldStore(store.database).read_world(1)
+    assert loaded.map == world.map
+    assert loaded.map.exits == world.map.exits
+    assert loaded.location == world.location
+    assert loaded.status == WorldStatus.Started
+    assert loaded.town_ready(1)
+
+def test_map_is_only_written_when_it_changed():
+    store = WorldStore(SQLiteDatabase(":memory:"))
+    world = make_world()
+    store.collect_changes(1, world)
+
+    world.location = Point(2, 1)
+    statements = store.collect_changes(1, world)
+    assert [sql.split()[4] for sql, _ in statements] == ["worlds"]
+
+    world.map.set(Point(1, 2), 1, 4)
+    statements = store.collect_changes(1, world)
+    assert [sql.split()[4] for sql, _ in statements] == ["maps"]
@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+import scheduler
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_TEST_RPM', '60')
+    monkeypatch.setenv('RATE_LIMIT_TEST_TPM', '6000')
+    yield
+    scheduler.share_rate_limits(1)
+
+def test_limits(limits):
+    limiter = scheduler.get_limiter('test')
+    assert limiter.requests.rate == 1
+    assert limiter.requests.capacity == scheduler.RATE_LIMIT_BURST_SECONDS
+    assert limiter.tokens.rate == 100
+    assert scheduler.get_limiter('unlimited') is None
+
+def test_sharded_workers_share_the_limits(limits):
+    unsharded = scheduler.get_limiter('test')
+
+    # what each of four worker processes configures at start
+    scheduler.share_rate_limits(4)
+    limiter = scheduler.get_limiter('test')
+    assert limiter is not unsharded
+    assert limiter.requests.rate * 4 == unsharded.requests.rate
+    assert limiter.requests.capacity * 4 == unsharded.requests.capacity
+    assert limiter.tokens.rate * 4 == unsharded.tokens.rate
+
+    # a worker only gets its share of the burst
+    async def burst():
+        for _ in range(int(limiter.requests.capacity)):
+            await limiter.acquire(0, scheduler.Priority.INTERACTIVE)
+    asyncio.run(burst())
+    assert limiter.delay(0) > 0
@@ -0,0 +1,18 @@
+import pytest
+
+import sharding
+
+def test_check_shards(tmp_path):
+    db_path = str(tmp_path / "chatquest.sqlite")
+    sharding.check_shards(db_path, 3)
+    sharding.check_shards(db_path, 3)
+    with pytest.raises(RuntimeError):
+        sharding.check_shards(db_path, 2)
+
+def test_check_shards_of_existing_worker_databases(tmp_path):
+    db_path = str(tmp_path / "chatquest.sqlite")
+    for worker_idx in range(2):
+        (tmp_path / f"chatquest.sqlite.w{worker_idx}").touch()
+    with pytest.raises(RuntimeError):
+        sharding.check_shards(db_path, 4)
+    sharding.check_shards(db_path, 2)
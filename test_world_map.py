@@ -0,0 +1,120 @@
+import pickle
+
+import mapgenerator
+from world import World, WorldMap, Town, Point
+
+GRID = [
+    ['1:1', '1:2', ''],
+    ['', '1:3', '2:1'],
+    ['3:1', '', '2:2'],
+]
+
+def test_grid_round_trip():
+    world_map = WorldMap.from_grid(GRID)
+    assert (world_map.width, world_map.height) == (3, 3)
+    assert world_map.to_grid() == GRID
+
+    grid, _, _ = mapgenerator.generate_map(5, 3, 5, seed=1)
+    assert WorldMap.from_grid(grid).to_grid() == grid
+
+def test_index():
+    world_map = WorldMap.from_grid(GRID)
+    assert world_map.place_key_at(Point(2, 2)) == "1:3"
+    assert world_map.place_key_at(Point(1, 2)) is None
+    assert world_map.location_of("2:2") == Point(3, 3)
+    assert world_map.town_at(Point(4, 1)) == 0
+    assert world_map.town_places_count() == {1: 3, 2: 2, 3: 1}
+
+def test_pickle_rebuilds_index():
+    world_map = WorldMap.from_grid(GRID)
+    state = world_map.__getstate__()
+    assert set(state) == {'width', 'height', 'towns', 'places'}
+
+    loaded = pickle.loads(pickle.dumps(world_map))
+    assert loaded == world_map
+    assert loaded.keys == world_map.keys
+    assert loaded.cells == world_map.cells
+    assert loaded.exits == world_map.exits
+
+def test_exits():
+    world_map = WorldMap.from_grid(GRID)
+    assert world_map.exits[world_map.offset(Point(2, 1))] == WorldMap.SOUTH | WorldMap.WEST
+    assert world_map.exits[world_map.offset(Point(1, 3))] == 0
+
+def assert_path(world_map, start, path, town_idx):
+    steps = [start] + path
+    for a, b in zip(steps, steps[1:]):
+        assert abs(a.x - b.x) + abs(a.y - b.y) == 1
+        assert world_map.occupied(b)
+    assert world_map.town_at(path[-1]) == town_idx
+    assert all(world_map.town_at(step) != town_idx for step in steps[:-1])
+
+def test_shortest_path():
+    world_map = WorldMap.from_grid(GRID)
+    path = world_map.shortest_path(Point(1, 1), 2)
+    assert path == [Point(2, 1), Point(2, 2), Point(3, 2)]
+    assert_path(world_map, Point(1, 1), path, 2)
+    assert world_map.shortest_path(Point(1, 1), 1) == []
+    # town 3 has no neighbour
+    assert world_map.shortest_path(Point(1, 1), 3) is None
+
+def test_shortest_path_on_generated_maps():
+    for seed in range(10):
+        grid, town_places, start_location = mapgenerator.generate_map(5, 3, 5, seed=seed)
+        world_map = WorldMap.from_grid(grid)
+        start = Point(*start_location)
+        for town_idx in range(2, len(town_places) + 1):
+            assert_path(world_map, start, world_map.shortest_path(start, town_idx), town_idx)
+
+def test_find_town():
+    world = World()
+    world.init_towns([Town(name="Saltmarsh", description=""), Town(name="Salt Hollow", description=""),
+                      Town(name="Brindle", description="")])
+    assert world.find_town("2") == 2
+    assert world.find_town("4") is None
+    assert world.find_town("salt hollow") == 2
+    assert world.find_town(" BRIN ") == 3
+    assert world.find_town("salt") == 1
+    assert world.find_town("") is None
+    assert world.find_town("nowhere") is None
+
+def test_grow():
+    world_map = WorldMap.from_grid(GRID)
+    world_map.grow(2, 1, 6, 5)
+    assert (world_map.width, world_map.height) == (6, 5)
+    assert world_map.location_of("1:1") == Point(3, 2)
+    assert world_map.location_of("2:2") == Point(5, 4)
+    assert world_map.town_at(Point(1, 1)) == 0
+    assert [row[2:5] for row in world_map.to_grid()[1:4]] == GRID
+    assert world_map.shortest_path(Point(3, 2), 2) == [Point(4, 2), Point(4, 3), Point(5, 3)]
+
+def test_planes_round_trip():
+    world_map = WorldMap.from_grid(GRID)
+    loaded = WorldMap.from_planes(world_map.width, world_map.height, *world_map.to_planes())
+    assert loaded == world_map
+    assert loaded.exits == world_map.exits
+    assert loaded.keys == world_map.keys
+    assert loaded.revision != world_map.revision
+
+def test_revision_changes_with_the_map():
+    world_map = WorldMap.from_grid(GRID)
+    revision = world_map.revision
+    world_map.set(Point(3, 1), 4, 1)
+    assert world_map.revision != revision
+    revision = world_map.revision
+    world_map.grow(1, 0, 4, 3)
+    assert world_map.revision != revision
+
+def test_can_move_follows_the_exits():
+    world = World()
+    world.map = WorldMap.from_grid(GRID)
+    world.location = Point(2, 1)
+    assert world.can_move(Point(2, 2))
+    assert world.can_move(Point(1, 1))
+    assert not world.can_move(Point(3, 1))
+    assert not world.can_move(Point(3, 2))
+
+    # a closed exit blocks the move although the cell is a place
+    world.map.exits[world.map.offset(Point(2, 1))] &= ~WorldMap.SOUTH
+    assert world.map.occupied(Point(2, 2))
+    assert not world.can_move(Point(2, 2))
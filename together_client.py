@@ -1,13 +1,14 @@
-from together import Together
+from together import Together, AsyncTogether
 import prompts
-from pprint import pprint
 from ai_client import AIClient
 
 class TogetherClient(AIClient):
     def __init__(self, api_key: str):
         super().__init__("Llama")
         self.client = Together(api_key=api_key)
+        self.async_client = AsyncTogether(api_key=api_key)
         self.model = "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo"
+        self.deterministic_json = True
 
     def init_chat(self):
         self.messages = [
@@ -49,3 +50,59 @@ class TogetherClient(AIClient):
         self.log_response_object(data)
 
         return data
+
+    async def aget_response(self):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0
+            )
+            call.usage(response.usage)
+
+        text = response.choices[0].message.content
+        self.messages.append({ "role": "assistant", "content": text })
+        return text
+
+    async def astream_response(self):
+        await self.acquire_quota()
+        text = ""
+        with self.track_call() as call:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                temperature=1.0,
+                stream=True
+            )
+            async for chunk in stream:
+                call.usage(getattr(chunk, 'usage', None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    call.first_byte()
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+
+        self.messages.append({ "role": "assistant", "content": text })
+        self.log_response_text(text)
+
+    async def aget_json_response(self, type):
+        await self.acquire_quota()
+        with self.track_call() as call:
+            completion = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages = self.messages,
+                temperature = 0,
+                response_format={
+                    "type": "json_object",
+                    "schema": type.model_json_schema(),
+                }
+            )
+            call.usage(completion.usage)
+
+        json_data = completion.choices[0].message.content
+        self.log_response_json(json_data)
+
+        data = type.model_validate_json(json_data)
+        self.log_response_object(data)
+
+        return data
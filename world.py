@@ -1,3 +1,7 @@
+import asyncio
+import itertools
+from array import array
+from collections import deque
 from typing import Dict, List
 from collections import namedtuple
 from enum import Enum
@@ -25,6 +29,215 @@ class PlaceList(BaseModel):
 class NPCList(BaseModel):
     items: List[NPC]
 
+class InteractionOutcome(BaseModel):
+    narration: str
+    description: str
+    appearance: str
+
+class TownBlueprint(BaseModel):
+    name: str
+    description: str
+    places: List[Place]
+    npcs: List[NPC]
+
+class WorldBlueprint(BaseModel):
+    description: str
+    towns: List[TownBlueprint]
+
+class WorldMap:
+    """
+    The map as two integer planes, the town id and the place id of every
+    cell (0 where there is no place), plus an index between place keys
+    ("town:place") and cells. Locations are 1-based Points.
+
+    The adjacency graph is kept as a plane of exit bits per cell (the
+    directions in which the neighbouring cell is a place).
+
+    revision changes with every change of the map and is unique in the
+    process, so that the store can tell whether a map has to be written.
+    """
+    # exit bits and the step of each direction
+    NORTH, SOUTH, EAST, WEST = 1, 2, 4, 8
+    STEPS = ((NORTH, 0, -1), (SOUTH, 0, 1), (EAST, 1, 0), (WEST, -1, 0))
+    OPPOSITE = {NORTH: SOUTH, SOUTH: NORTH, EAST: WEST, WEST: EAST}
+
+    revisions = itertools.count(1)
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.towns = array('H', bytes(2 * width * height))
+        self.places = array('H', bytes(2 * width * height))
+        self.build_index()
+
+    def build_index(self, exits: bytes = None):
+        """Build the index, and the exits unless they are given (as stored by to_planes)."""
+        self.revision = next(WorldMap.revisions)
+        self.exits = array('B', exits if exits is not None else bytes(self.width * self.height))
+        # keys[town_idx][place_idx] is the place key and cells[town_idx][place_idx] its offset
+        self.keys: List[List[str]] = [[]]
+        self.cells: List[array] = [array('I')]
+        for offset, town_idx in enumerate(self.towns):
+            if town_idx != 0:
+                self.add_key(offset, town_idx, self.places[offset])
+                if exits is None:
+                    self.add_exits(offset)
+
+    def add_exits(self, offset: int):
+        """Connect an occupied cell with its occupied neighbours."""
+        x, y = offset % self.width, offset // self.width
+        for bit, dx, dy in self.STEPS:
+            if 0 <= x + dx < self.width and 0 <= y + dy < self.height:
+                neighbor = offset + dy * self.width + dx
+                if self.towns[neighbor] != 0:
+                    self.exits[offset] |= bit
+                    self.exits[neighbor] |= self.OPPOSITE[bit]
+
+    def add_key(self, offset: int, town_idx: int, place_idx: int):
+        while len(self.keys) <= town_idx:
+            self.keys.append([''])
+            self.cells.append(array('I', [0]))
+        keys, cells = self.keys[town_idx], self.cells[town_idx]
+        while len(keys) <= place_idx:
+            keys.append('')
+            cells.append(0)
+        keys[place_idx] = "{}:{}".format(town_idx, place_idx)
+        cells[place_idx] = offset
+
+    # only the planes are pickled, the index is rebuilt when loaded
+    def __getstate__(self):
+        return {'width': self.width, 'height': self.height, 'towns': self.towns, 'places': self.places}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_index()
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, WorldMap) and self.width == other.width and self.height == other.height
+                and self.towns == other.towns and self.places == other.places)
+
+    @staticmethod
+    def from_grid(grid: List[List[str]]) -> 'WorldMap':
+        """Build the map from rows of "town:place" labels as returned by mapgenerator.generate_map."""
+        world_map = WorldMap(len(grid[0]) if grid else 0, len(grid))
+        for y, row in enumerate(grid, start=1):
+            for x, cell in enumerate(row, start=1):
+                if cell != '':
+                    town_idx, place_idx = cell.split(':')
+                    world_map.set(Point(x, y), int(town_idx), int(place_idx))
+        return world_map
+
+    @staticmethod
+    def from_planes(width: int, height: int, towns: bytes, places: bytes, exits: bytes) -> 'WorldMap':
+        """Build the map from the bytes of its planes as returned by to_planes."""
+        world_map = WorldMap.__new__(WorldMap)
+        world_map.width = width
+        world_map.height = height
+        world_map.towns = array('H')
+        world_map.towns.frombytes(towns)
+        world_map.places = array('H')
+        world_map.places.frombytes(places)
+        world_map.build_index(exits)
+        return world_map
+
+    def to_planes(self):
+        """The bytes of the town, place and exit planes."""
+        return self.towns.tobytes(), self.places.tobytes(), self.exits.tobytes()
+
+    def to_grid(self) -> List[List[str]]:
+        grid = [['' for _ in range(self.width)] for _ in range(self.height)]
+        for offset, town_idx in enumerate(self.towns):
+            if town_idx != 0:
+                grid[offset // self.width][offset % self.width] = self.keys[town_idx][self.places[offset]]
+        return grid
+
+    def offset(self, location: Point) -> int:
+        """Offset of a location in the planes, or -1 if it is off the map."""
+        if location.x < 1 or location.y < 1 or location.x > self.width or location.y > self.height:
+            return -1
+        return (location.y - 1) * self.width + location.x - 1
+
+    def location(self, offset: int) -> Point:
+        return Point(offset % self.width + 1, offset // self.width + 1)
+
+    def set(self, location: Point, town_idx: int, place_idx: int):
+        offset = self.offset(location)
+        self.towns[offset] = town_idx
+        self.places[offset] = place_idx
+        self.add_key(offset, town_idx, place_idx)
+        self.add_exits(offset)
+        self.revision = next(WorldMap.revisions)
+
+    def grow(self, shift_x: int, shift_y: int, width: int, height: int):
+        """Enlarge the map to width x height, moving every cell by (shift_x, shift_y)."""
+        towns, places, old_width = self.towns, self.places, self.width
+        self.width, self.height = width, height
+        self.towns = array('H', bytes(2 * width * height))
+        self.places = array('H', bytes(2 * width * height))
+        for y in range(len(towns) // old_width if old_width else 0):
+            start = (y + shift_y) * width + shift_x
+            self.towns[start:start + old_width] = towns[y * old_width:(y + 1) * old_width]
+            self.places[start:start + old_width] = places[y * old_width:(y + 1) * old_width]
+        self.build_index()
+
+    def occupied(self, location: Point) -> bool:
+        offset = self.offset(location)
+        return offset >= 0 and self.towns[offset] != 0
+
+    def has_exit(self, start: Point, target: Point) -> bool:
+        """Whether the adjacency graph leads from start to its neighbour target."""
+        offset = self.offset(start)
+        if offset < 0:
+            return False
+        for bit, dx, dy in self.STEPS:
+            if target.x - start.x == dx and target.y - start.y == dy:
+                return bool(self.exits[offset] & bit)
+        return False
+
+    def town_at(self, location: Point) -> int:
+        """Town id (1-based) at a location, 0 if there is no place."""
+        offset = self.offset(location)
+        return self.towns[offset] if offset >= 0 else 0
+
+    def place_key_at(self, location: Point) -> str:
+        offset = self.offset(location)
+        if offset < 0 or self.towns[offset] == 0:
+            return None
+        return self.keys[self.towns[offset]][self.places[offset]]
+
+    def location_of(self, place_key: str) -> Point:
+        town_idx, place_idx = (int(part) for part in place_key.split(':'))
+        return self.location(self.cells[town_idx][place_idx])
+
+    def shortest_path(self, start: Point, town_idx: int) -> List[Point]:
+        """
+        Breadth-first search over the adjacency graph for the nearest place of
+        a town. Returns the locations of every step after start, or None if
+        the town cannot be reached.
+        """
+        start_offset = self.offset(start)
+        previous = {start_offset: -1}
+        queue = deque([start_offset])
+        while queue:
+            offset = queue.popleft()
+            if self.towns[offset] == town_idx:
+                path = []
+                while offset != start_offset:
+                    path.append(self.location(offset))
+                    offset = previous[offset]
+                return path[::-1]
+            exits = self.exits[offset]
+            for bit, dx, dy in self.STEPS:
+                if exits & bit:
+                    neighbor = offset + dy * self.width + dx
+                    if neighbor not in previous:
+                        previous[neighbor] = offset
+                        queue.append(neighbor)
+        return None
+
+    def town_places_count(self) -> Dict[int, int]:
+        return {town_idx: len(places) - 1 for town_idx, places in enumerate(self.keys) if town_idx != 0 and len(places) > 1}
+
 class WorldStatus(Enum):
     NotStarted = 1
     Creating = 2
@@ -49,6 +262,13 @@ class World:
         self.npcs_dict: Dict[str, List[NPC]] = {}
         self.selected_npc_index = 0
 
+        # readiness of each town (1-indexed) when towns are generated progressively
+        self.towns_ready: Dict[int, asyncio.Event] = {}
+        self.creation_task: asyncio.Task = None
+        self.prefetcher = None
+        # chunks.WorldChunks when the world grows as it is explored
+        self.chunks = None
+
         self.status = WorldStatus.NotStarted
         self.current_town = None
 
@@ -72,21 +292,73 @@ class World:
         
         center = Point(x=len(board[0]) // 2, y=len(board) // 2)
         
-        self.map = board
+        self.map = WorldMap.from_grid(board)
         self.location = center
         return self.map, self.location
     
+    def init_towns(self, towns: List[Town]):
+        self.towns = towns
+        self.towns_images = [None] * len(towns)
+        self.towns_ready = {town_idx: asyncio.Event() for town_idx in range(1, len(towns) + 1)}
+
+    def add_towns(self, towns: List[Town]):
+        for town in towns:
+            self.towns.append(town)
+            self.towns_images.append(None)
+            self.towns_ready[len(self.towns)] = asyncio.Event()
+
+    def explored(self, town_idx: int) -> bool:
+        """Whether a town exists beyond its place on the map; always true unless the world is chunked."""
+        return self.chunks is None or town_idx not in self.chunks.unexplored
+
+    def set_town_ready(self, town_idx: int):
+        self.towns_ready[town_idx].set()
+
+    def town_ready(self, town_idx: int) -> bool:
+        return town_idx in self.towns_ready and self.towns_ready[town_idx].is_set()
+
+    async def wait_town_ready(self, town_idx: int, timeout: float) -> bool:
+        if town_idx not in self.towns_ready:
+            return False
+        try:
+            await asyncio.wait_for(self.towns_ready[town_idx].wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def get_town_idx(self, location: Point) -> int:
+        return self.map.town_at(location)
+
+    def find_town(self, name: str) -> int:
+        """Town id (1-based) by number, name or start of a name; None if there is no such town."""
+        name = name.strip().lower()
+        if not name:
+            return None
+        if name.isdigit():
+            town_idx = int(name)
+            return town_idx if 1 <= town_idx <= len(self.towns or []) else None
+        for town_idx, town in enumerate(self.towns or [], start=1):
+            if town.name.lower() == name:
+                return town_idx
+        for town_idx, town in enumerate(self.towns or [], start=1):
+            if town.name.lower().startswith(name):
+                return town_idx
+        return None
+
+    def get_town_places_count(self) -> Dict[int, int]:
+        return self.map.town_places_count()
+
     def init_npc_dict(self):
         for key in self.places_dict.keys():
             self.npcs_dict[key] = []
 
     def get_place_key(self) -> str:
-        return self.map[self.location.y - 1][self.location.x - 1]
+        return self.map.place_key_at(self.location)
 
     def get_current_place(self) -> tuple[int, Town, str, Place]:
         place_key = self.get_place_key()
         place = self.places_dict[place_key]
-        town_index = int(place_key.split(':')[0]) - 1
+        town_index = self.map.town_at(self.location) - 1
         town = self.towns[town_index]
         return town_index, town, place_key, place
     
@@ -115,12 +387,12 @@ class World:
         self.places_npc_images_dict[self.get_place_key()].data = image
 
     def can_move(self, location: Point) -> bool:
-        if location.x < 1 or location.y < 1:
-            return False
-        if location.x > len(self.map[0]) or location.y > len(self.map):
-            return False
-        return self.map[location.y - 1][location.x - 1] != ''
+        """Whether the player can step from the current location to a neighbouring one."""
+        return self.map.has_exit(self.location, location)
     
+    def set_not_started(self):
+        self.status = WorldStatus.NotStarted
+
     def set_creating(self):
         self.status = WorldStatus.Creating
 
@@ -136,5 +408,61 @@ class World:
     def started(self) -> bool:
         return self.status == WorldStatus.Started
 
+    def busy(self) -> bool:
+        """Whether background work (creation or prefetching) still mutates the world."""
+        if self.creation_task is not None and not self.creation_task.done():
+            return True
+        if self.chunks is not None and self.chunks.busy():
+            return True
+        return self.prefetcher is not None and len(self.prefetcher.tasks) > 0
+
+    def memory_size(self) -> int:
+        """Rough number of bytes held by the world, dominated by its images."""
+        size = sum(len(image) for image in self.towns_images if image is not None)
+        size += sum(len(gen_image.data) for gen_image in self.places_npc_images_dict.values() if gen_image is not None and gen_image.data is not None)
+        size += sum(len(place.description) for place in self.places_dict.values())
+        size += sum(len(npc.description) + len(npc.appearance) for npc_list in self.npcs_dict.values() for npc in npc_list)
+        return size
+
+    def to_state(self) -> dict:
+        """Plain picklable state of the world, without its clients."""
+        return {
+            'description': self.description,
+            'towns': self.towns,
+            'towns_images': self.towns_images,
+            'map': self.map,
+            'location': tuple(self.location) if self.location else None,
+            'places_dict': self.places_dict,
+            'places_npc_images_dict': self.places_npc_images_dict,
+            'npcs_dict': self.npcs_dict,
+            'selected_npc_index': self.selected_npc_index,
+            'towns_ready': [town_idx for town_idx in self.towns_ready if self.town_ready(town_idx)],
+            'status': self.status,
+            'current_town': self.current_town,
+            'ai_messages': self.ai.messages if self.ai is not None else [],
+            'chunks': self.chunks,
+        }
+
+    @staticmethod
+    def from_state(state: dict) -> 'World':
+        world = World()
+        world.init_towns(state['towns'] or [])
+        world.towns = state['towns']
+        world.description = state['description']
+        world.towns_images = state['towns_images']
+        # worlds hibernated before the map became a WorldMap store the label grid
+        world.map = WorldMap.from_grid(state['map']) if isinstance(state['map'], list) else state['map']
+        world.location = Point(*state['location']) if state['location'] else None
+        world.places_dict = state['places_dict']
+        world.places_npc_images_dict = state['places_npc_images_dict']
+        world.npcs_dict = state['npcs_dict']
+        world.selected_npc_index = state['selected_npc_index']
+        for town_idx in state['towns_ready']:
+            world.set_town_ready(town_idx)
+        world.status = state['status']
+        world.current_town = state['current_town']
+        world.chunks = state.get('chunks')
+        return world
+
 
-__all__ = ['World', 'Town', 'Place', 'Point', 'Move']
+__all__ = ['World', 'WorldMap', 'Town', 'Place', 'Point', 'Move']
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import random
+from collections import namedtuple
+from typing import List
+
+import prompts, metaprompts
+import imaging
+import scheduler
+from client_factory import create_client
+from world import World, Town, TownList, PlaceList, NPC, NPCList, GenImage, WorldBlueprint
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of generation calls (LLM or image) in flight per world
+GEN_CONCURRENCY = int(os.getenv('GEN_CONCURRENCY', '4'))
+# further attempts at a town whose generation failed
+TOWN_RETRIES = int(os.getenv('TOWN_RETRIES', '2'))
+
+TownContent = namedtuple('TownContent', ['town_idx', 'places', 'image', 'npcs'])
+
+# Each stage gets its own conversation over the provider's shared client so
+# that concurrent stages never share messages (world.ai.messages is reserved
+# for the player).
+
+# The cached calls put everything their response depends on into the prompt,
+# so that a cached response is only reused for the same world.
+
+async def create_towns(provider: str, world_description: str, num_towns: int):
+    story_architect_ai = create_client(provider)
+    story_architect_ai.init_chat()
+
+    await story_architect_ai.aprompt(prompts.CREATE_TOWNS.format(num_towns, world_description), call_site="CREATE_TOWNS")
+
+    return (await story_architect_ai.aget_cached_json_response(type = TownList)).items
+
+async def create_more_towns(provider: str, world_description: str, existing_names: List[str], num_towns: int):
+    """Towns for a world that already has some. Not cached: each call should give new towns."""
+    story_architect_ai = create_client(provider)
+    story_architect_ai.init_chat()
+
+    instruction = prompts.CREATE_MORE_TOWNS.format(num_towns, world_description, "\n".join(existing_names))
+    await story_architect_ai.aprompt(instruction, call_site="CREATE_MORE_TOWNS")
+
+    return (await story_architect_ai.aget_json_response(type = TownList)).items
+
+async def create_places(provider: str, world_description: str, town: Town, num_places: int):
+    ai = create_client(provider)
+    ai.init_chat()
+
+    instruction = prompts.CREATE_PLACES.format(num_places, world_description, town.description)
+    await ai.aprompt(instruction, call_site="CREATE_PLACES")
+
+    return (await ai.aget_cached_json_response(type = PlaceList)).items
+
+async def create_town_image(provider: str, town: Town) -> bytes:
+    metaprompter = create_client(provider)
+    metaprompter.reset()
+
+    meta_prompt = metaprompts.TOWN_IMAGE.format(town.description)
+    await metaprompter.aprompt(meta_prompt, call_site="TOWN_IMAGE")
+    img_prompt = await metaprompter.aget_response()
+
+    image_data = await imaging.generate_image_large(img_prompt, call_site="TOWN_IMAGE")
+    if image_data is None:
+        logger.warning("No image for town", extra={'town': town.name})
+    else:
+        logger.info("Created image for town", extra={'town': town.name})
+    return image_data
+
+async def create_npcs(provider: str, world_description: str, town: Town, num_npcs: int):
+    ai = create_client(provider)
+    ai.init_chat()
+
+    instruction = prompts.CREATE_NPCS.format(num_npcs, world_description, town.description)
+    await ai.aprompt(instruction, call_site="CREATE_NPCS")
+
+    return (await ai.aget_cached_json_response(type = NPCList)).items
+
+async def create_blueprint(provider: str, theme: str, town_places_count) -> WorldBlueprint:
+    """Create the world description and every town with its places and NPCs in one call."""
+    story_architect_ai = create_client(provider)
+    story_architect_ai.init_chat()
+
+    towns_text = "\n".join(
+        "Town {}: {} places, {} characters".format(town_idx, num_places, num_places)
+        for town_idx, num_places in sorted(town_places_count.items())
+    )
+    await story_architect_ai.aprompt(prompts.CREATE_WORLD_BLUEPRINT.format(theme, towns_text), call_site="CREATE_WORLD_BLUEPRINT")
+
+    return await story_architect_ai.aget_json_response(type = WorldBlueprint)
+
+def add_blueprint(world: World, blueprint: WorldBlueprint, town_places_count):
+    """
+    Map a blueprint into the world, marking every town ready. Extra towns and
+    places are dropped; too few of either raises ValueError.
+    """
+    if len(blueprint.towns) < len(town_places_count):
+        raise ValueError("Blueprint has {} towns, the map needs {}".format(len(blueprint.towns), len(town_places_count)))
+
+    town_blueprints = blueprint.towns[:len(town_places_count)]
+    for town_idx, town_blueprint in enumerate(town_blueprints, start=1):
+        if len(town_blueprint.places) < town_places_count[town_idx]:
+            raise ValueError("Blueprint town {} has {} places, the map needs {}".format(
+                town_idx, len(town_blueprint.places), town_places_count[town_idx]))
+
+    world.description = blueprint.description
+    world.init_towns([Town(name=town_blueprint.name, description=town_blueprint.description) for town_blueprint in town_blueprints])
+    for town_idx, town_blueprint in enumerate(town_blueprints, start=1):
+        places = town_blueprint.places[:town_places_count[town_idx]]
+        add_town(world, TownContent(town_idx, places, None, town_blueprint.npcs))
+        world.set_town_ready(town_idx)
+
+async def generate_town_images(world: World, metaprompter_provider: str, town_idxs = None,
+                               concurrency: int = GEN_CONCURRENCY):
+    """Generate the pictures of the given towns (default: every town without one)."""
+    if town_idxs is None:
+        town_idxs = [town_idx for town_idx in range(1, len(world.towns) + 1)
+                     if world.towns_images[town_idx - 1] is None and world.explored(town_idx)]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate(town_idx: int):
+        image = await limited(semaphore, create_town_image(metaprompter_provider, world.towns[town_idx - 1]))
+        world.towns_images[town_idx - 1] = image
+
+    await asyncio.gather(*(generate(town_idx) for town_idx in town_idxs))
+
+def get_npcs_text(npc_list: List[NPC]) -> tuple[int, str]:
+    text = ""
+    ctr = 0
+    for npc in npc_list:
+        ctr += 1
+        text += "{}. {} {}\n".format(ctr, npc.description, npc.appearance)
+    return ctr, text
+
+async def get_npcs_image(metaprompter, npc_list) -> bytes:
+    num, npcs_text = get_npcs_text(npc_list)
+    meta_prompt = metaprompts.CHARACTERS.format(npcs_text)
+
+    metaprompter.reset()
+    await metaprompter.aprompt(meta_prompt, call_site="CHARACTERS")
+    img_prompt = await metaprompter.aget_response()
+
+    image = await imaging.generate_image_dynamic(img_prompt, cells = num, call_site="CHARACTERS")
+    return image
+
+async def limited(semaphore: asyncio.Semaphore, coro):
+    async with semaphore:
+        return await coro
+
+async def generate_town(world: World, town_idx: int, num_places: int,
+                        ai_provider: str, metaprompter_provider: str,
+                        semaphore: asyncio.Semaphore) -> TownContent:
+    """Generate the places, picture and NPCs of one town (1-indexed) concurrently."""
+    town = world.towns[town_idx - 1]
+    places, image, npcs = await asyncio.gather(
+        limited(semaphore, create_places(ai_provider, world.description, town, num_places)),
+        limited(semaphore, create_town_image(metaprompter_provider, town)),
+        limited(semaphore, create_npcs(ai_provider, world.description, town, num_places)),
+    )
+    return TownContent(town_idx, places, image, npcs)
+
+def add_town(world: World, content: TownContent):
+    """Join the generated content of one town into the world."""
+    place_keys = []
+    for place_idx, place in enumerate(content.places, start=1):
+        place_key = "{}:{}".format(content.town_idx, place_idx)
+        world.places_dict[place_key] = place
+        world.npcs_dict[place_key] = []
+        place_keys.append(place_key)
+
+    world.towns_images[content.town_idx - 1] = content.image
+
+    for npc in content.npcs:
+        selected_place_key = random.choice(place_keys)
+        world.npcs_dict[selected_place_key].append(npc)
+        logger.debug("Adding NPC", extra={'place_key': selected_place_key, 'npc': npc.description})
+
+    # initialize empty image objects for the NPCs in each place
+    for place_key in place_keys:
+        if len(world.npcs_dict[place_key]) == 0:
+            world.places_npc_images_dict[place_key] = None
+        else:
+            world.places_npc_images_dict[place_key] = GenImage(data=bytes(), dirty=True)
+
+async def generate_towns(world: World, town_places_count, ai_provider: str, metaprompter_provider: str,
+                         town_idxs = None, concurrency: int = GEN_CONCURRENCY) -> List[int]:
+    """
+    Fan out generation of the given towns (default: every town in world.towns).
+
+    Each town is joined into the world and marked ready as soon as its own
+    content is complete. A town that fails is tried again up to TOWN_RETRIES
+    times without holding up the others. world.init_towns must have been
+    called first.
+
+    Returns:
+        The towns that could not be generated.
+    """
+    if town_idxs is None:
+        town_idxs = range(1, len(world.towns) + 1)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate(town_idx: int) -> bool:
+        for attempt in range(1, TOWN_RETRIES + 2):
+            try:
+                content = await generate_town(world, town_idx, town_places_count[town_idx],
+                                              ai_provider, metaprompter_provider, semaphore)
+            except Exception:
+                logger.warning("Town generation failed", extra={'town_idx': town_idx, 'attempt': attempt}, exc_info=True)
+                continue
+            add_town(world, content)
+            world.set_town_ready(town_idx)
+            logger.info("Town is ready", extra={'town_idx': town_idx})
+            return True
+        return False
+
+    results = await asyncio.gather(*(generate(town_idx) for town_idx in town_idxs))
+    return [town_idx for town_idx, ready in zip(town_idxs, results) if not ready]
+
+async def generate_remaining_towns(world: World, town_places_count, ai_provider: str, metaprompter_provider: str):
+    """Background task filling in every town that is not ready yet and every missing town picture."""
+    # players in conversation go first
+    scheduler.set_priority(scheduler.Priority.BULK)
+    town_idxs = [town_idx for town_idx in world.towns_ready if not world.town_ready(town_idx) and world.explored(town_idx)]
+    try:
+        failed = await generate_towns(world, town_places_count, ai_provider, metaprompter_provider, town_idxs)
+        if failed:
+            # a player heading to one of them restarts the generation
+            logger.error("Towns left unfinished", extra={'town_idxs': failed})
+        await generate_town_images(world, metaprompter_provider)
+    except Exception:
+        logger.exception("Background town generation failed")